@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Stream bundles of files as tar or zip archives, without temporary files.
+"""
+
+import os
+import io
+import time
+import tarfile
+import zipfile
+import contextlib
+
+import attr
+
+__all__ = ['Member', 'stream_tar', 'stream_zip', 'CHUNKSIZE']
+
+#: Size of the chunks read from each member file.
+CHUNKSIZE = 4 * 1024 * 1024
+
+@contextlib.contextmanager
+def _local(path):
+    """A path which is already available."""
+    yield path
+
+@attr.s
+class Member(object):
+    """A file in an archive, with the size and modification time it is archived with.
+
+    ``open()`` returns a context manager for a local path to the file, which only has
+    to be available while the member is read, so remote files can be fetched lazily.
+    """
+    arcname = attr.ib()
+    size = attr.ib()
+    mtime = attr.ib()
+    open = attr.ib()
+
+    @classmethod
+    def from_path(cls, arcname, path):
+        """A member for a local file, archived at its current size."""
+        stat = os.stat(path)
+        return cls(arcname, stat.st_size, stat.st_mtime, lambda: _local(path))
+
+def _members(members):
+    """Members, from Member objects or (arcname, path) pairs."""
+    return [member if isinstance(member, Member) else Member.from_path(*member) for member in members]
+
+def _read_chunks(path, size, chunksize=CHUNKSIZE):
+    """Read exactly size bytes from a file in chunks, padding with zeros if it has shrunk."""
+    with open(path, 'rb') as f:
+        remaining = size
+        while remaining > 0:
+            chunk = f.read(min(chunksize, remaining))
+            if not chunk:
+                chunk = b"\0" * min(chunksize, remaining)
+            remaining -= len(chunk)
+            yield chunk
+
+def stream_tar(members, chunksize=CHUNKSIZE):
+    """Stream members, or (arcname, path) pairs, as a tar archive.
+
+    Returns the length of the archive and an iterator over its bytes. Members
+    are archived at their given size. Each member is opened just before its
+    header is sent, and closed once it has been read.
+    """
+    entries = []
+    for member in _members(members):
+        info = tarfile.TarInfo(member.arcname)
+        info.size = member.size
+        info.mtime = member.mtime or 0
+        info.mode = 0o644
+        entries.append((info.tobuf(format=tarfile.PAX_FORMAT), member))
+
+    def padding(size):
+        return -size % tarfile.BLOCKSIZE
+
+    length = sum(len(header) + member.size + padding(member.size) for header, member in entries) + 2 * tarfile.BLOCKSIZE
+
+    def generate():
+        for header, member in entries:
+            with member.open() as path:
+                yield header
+                for chunk in _read_chunks(path, member.size, chunksize):
+                    yield chunk
+            if padding(member.size):
+                yield b"\0" * padding(member.size)
+        yield b"\0" * (2 * tarfile.BLOCKSIZE)
+    return length, generate()
+
+class _Sink(io.RawIOBase):
+    """An unseekable stream which collects written bytes until they are taken."""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def take(self):
+        """Take the bytes written since the last call."""
+        data, self._chunks = b"".join(self._chunks), []
+        return data
+
+def stream_zip(members, chunksize=CHUNKSIZE):
+    """Stream members, or (arcname, path) pairs, as an uncompressed zip archive, yielding its bytes.
+
+    Each member is opened only while it is read.
+    """
+    sink = _Sink()
+    with zipfile.ZipFile(sink, mode='w', compression=zipfile.ZIP_STORED, allowZip64=True) as archive:
+        for member in _members(members):
+            with member.open() as path:
+                # Zip can't record times before 1980.
+                date_time = max(tuple(time.localtime(member.mtime)[:6]), (1980, 1, 1, 0, 0, 0))
+                info = zipfile.ZipInfo(member.arcname, date_time=date_time)
+                info.compress_type = zipfile.ZIP_STORED
+                with archive.open(info, mode='w', force_zip64=True) as dest:
+                    for chunk in _read_chunks(path, member.size, chunksize):
+                        dest.write(chunk)
+                        yield sink.take()
+    # The central directory is written when the archive is closed.
+    yield sink.take()
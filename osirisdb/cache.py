@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+A bounded cache of files on disk, with least-recently-used eviction.
+"""
+
+import os
+import time
+import json
+import fcntl
+import atexit
+import hashlib
+import tempfile
+import threading
+import contextlib
+import collections
+
+import attr
+import click
+from flask import current_app
+
+from .application import app
+
+__all__ = ['FileCache', 'preview_cache', 'opreviewcache']
+
+STATS = "stats.json"
+
+#: Hits and misses are counted in memory, and added to the statistics file after
+#: this many lookups, or this many seconds, so that lookups don't contend for it.
+STATS_BATCH = 100
+STATS_INTERVAL = 10.0
+
+_pending = collections.defaultdict(collections.Counter)
+_flushed = {}
+_pending_lock = threading.Lock()
+
+def _same_file(f, path):
+    """Whether an open file is still the file at path."""
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return False
+    opened = os.fstat(f.fileno())
+    return (stat.st_dev, stat.st_ino) == (opened.st_dev, opened.st_ino)
+
+def _remove(path):
+    """Remove a file, if it exists."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+@attr.s
+class FileCache(object):
+    """A directory of cached files.
+
+    Files are written atomically (to a temporary file, then renamed), and
+    once the cache grows past ``budget`` bytes the least recently used files
+    are removed. Hits and misses are counted in a statistics file shared by
+    every process using the cache, in batches.
+
+    Each entry has a lock file, which is removed along with the entry. Lockers
+    check that they locked the lock file which is still in place, so that every
+    process locks the same file for an entry.
+    """
+
+    directory = attr.ib()
+    budget = attr.ib(default=None)
+
+    @staticmethod
+    def key(*parts):
+        """Make a cache key from parts which identify the cached content."""
+        return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+    def path(self, key, suffix=""):
+        """The path to a cache entry."""
+        return os.path.join(self.directory, key[:2], key + suffix)
+
+    def get(self, key, suffix=""):
+        """Get the path to a cache entry, or None if it isn't cached."""
+        path = self.path(key, suffix)
+        try:
+            # The modification time is the last use, for eviction.
+            os.utime(path, None)
+        except FileNotFoundError:
+            self._record(misses=1)
+            return None
+        self._record(hits=1)
+        return path
+
+    def contains(self, key, suffix=""):
+        """Whether an entry is cached, without counting a hit or miss."""
+        return os.path.exists(self.path(key, suffix))
+
+    def put(self, key, write, suffix=""):
+        """Add a cache entry, with ``write(path)`` writing the content to a temporary path."""
+        path = self.path(key, suffix)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, partial = tempfile.mkstemp(dir=directory, suffix=".partial")
+        os.close(fd)
+        try:
+            write(partial)
+            os.replace(partial, path)
+        finally:
+            if os.path.exists(partial):
+                os.remove(partial)
+        stats = self._record(size=os.path.getsize(path))
+        if self.budget is not None and stats['size'] > self.budget:
+            self.evict()
+        return path
+
+    @contextlib.contextmanager
+    def _locked(self, path, operation):
+        """Hold a lock on the lock file of the entry at path, with ``operation`` passed to :func:`fcntl.flock`.
+
+        The lock file may be removed while waiting for the lock, so once it is held, the
+        lock file must still be the one at its path, or the lock is taken again.
+        """
+        while True:
+            with open(path + ".lock", "a") as f:
+                fcntl.flock(f, operation)
+                try:
+                    if _same_file(f, path + ".lock"):
+                        yield path
+                        return
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    @contextlib.contextmanager
+    def lock(self, key, suffix=""):
+        """Hold an exclusive lock on a cache entry, shared between processes."""
+        path = self.path(key, suffix)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._locked(path, fcntl.LOCK_EX):
+            yield path
+
+    def get_or_put(self, key, write, suffix=""):
+        """Get a cache entry, creating it if it isn't cached.
+
+        Only one process writes a missing entry. Any others wait for the lock
+        on that entry, then use the entry which was written.
+        """
+        path = self.get(key, suffix)
+        if path is not None:
+            return path
+        with self.lock(key, suffix) as path:
+            if os.path.exists(path):
+                return path
+            try:
+                return self.put(key, write, suffix)
+            except BaseException:
+                # Nothing was cached, so the lock file isn't kept either.
+                _remove(path + ".lock")
+                raise
+
+    @contextlib.contextmanager
+    def pinned(self, key, write, suffix=""):
+        """Get a cache entry, creating it if it isn't cached, and keep it from being evicted while it is used."""
+        while True:
+            path = self.get_or_put(key, write, suffix)
+            with self._locked(path, fcntl.LOCK_SH):
+                # The entry may have been evicted before it was pinned.
+                if os.path.exists(path):
+                    yield path
+                    return
+
+    def _entries(self):
+        """Iterate over (path, stat) for every cache entry."""
+        for root, directories, files in os.walk(self.directory):
+            for name in files:
+                if name == STATS or name.endswith((".partial", ".lock")):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    yield path, os.stat(path)
+                except FileNotFoundError:
+                    continue
+
+    def _orphans(self):
+        """Iterate over the paths of entries which have a lock file, but no content."""
+        for root, directories, files in os.walk(self.directory):
+            names = set(files)
+            for name in files:
+                if name.endswith(".lock") and name[:-len(".lock")] not in names:
+                    yield os.path.join(root, name[:-len(".lock")])
+
+    def _remove_unlocked(self, path):
+        """Remove an entry and its lock file unless it is pinned or being written, returning whether it was removed."""
+        try:
+            with self._locked(path, fcntl.LOCK_EX | fcntl.LOCK_NB):
+                _remove(path)
+                # Anyone waiting for this lock file takes a new one once it is released.
+                _remove(path + ".lock")
+        except BlockingIOError:
+            return False
+        return True
+
+    def evict(self, budget=None):
+        """Remove the least recently used entries until the cache is within its budget.
+
+        Entries are removed down to 90% of the budget, so that eviction doesn't happen on every write.
+        Entries which are pinned, or being written, are kept.
+        """
+        budget = self.budget if budget is None else budget
+        entries = sorted(self._entries(), key=lambda entry: entry[1].st_mtime)
+        size = sum(stat.st_size for path, stat in entries)
+        removed = 0
+        if budget is not None and size > budget:
+            for path, stat in entries:
+                if size <= 0.9 * budget:
+                    break
+                if self._remove_unlocked(path):
+                    size -= stat.st_size
+                    removed += 1
+        for path in self._orphans():
+            self._remove_unlocked(path)
+        self._record(evictions=removed, size=None, total=size)
+        return removed
+
+    def clear(self):
+        """Remove every cache entry."""
+        return self.evict(budget=0)
+
+    @contextlib.contextmanager
+    def _stats_file(self):
+        """Open the statistics file, locked against other processes."""
+        os.makedirs(self.directory, exist_ok=True)
+        fd = os.open(os.path.join(self.directory, STATS), os.O_RDWR | os.O_CREAT)
+        with os.fdopen(fd, "r+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                text = f.read()
+                stats = json.loads(text) if text else {}
+                yield stats
+                f.seek(0)
+                f.truncate()
+                json.dump(stats, f)
+                # Written out before the lock is released, or another process may write between.
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _record(self, hits=0, misses=0, evictions=0, size=0, total=None):
+        """Update the cache statistics, returning them.
+        
+        Hits and misses alone are batched, and only written out once enough have
+        been counted, in which case this returns None.
+        """
+        with _pending_lock:
+            pending = _pending[self.directory]
+            pending.update(hits=hits, misses=misses)
+            lookups = pending['hits'] + pending['misses']
+            if not (evictions or size or total is not None or hits == misses == 0):
+                if lookups < STATS_BATCH and time.monotonic() - _flushed.get(self.directory, 0.0) < STATS_INTERVAL:
+                    return None
+            hits, misses = pending['hits'], pending['misses']
+            pending.clear()
+            _flushed[self.directory] = time.monotonic()
+        with self._stats_file() as stats:
+            for name, value in [('hits', hits), ('misses', misses), ('evictions', evictions), ('size', size)]:
+                if value:
+                    stats[name] = stats.get(name, 0) + value
+            if total is not None:
+                stats['size'] = total
+            for name in ('hits', 'misses', 'evictions', 'size'):
+                stats.setdefault(name, 0)
+            return dict(stats)
+
+    def stats(self):
+        """Hit, miss and eviction counts, and the size of the cache."""
+        return self._record()
+
+@atexit.register
+def _flush_stats():
+    """Write out the hits and misses counted by this process."""
+    for directory in list(_pending):
+        if any(_pending[directory].values()):
+            FileCache(directory).stats()
+
+def preview_cache():
+    """The cache for rendered previews."""
+    return FileCache(current_app.config['DATAFILE_PREVIEW_CACHE'],
+                     current_app.config.get('DATAFILE_PREVIEW_CACHE_SIZE', None))
+
+@app.cli.command()
+@click.option('--evict', is_flag=True, help="Evict least recently used previews down to the budget.")
+@click.option('--clear', is_flag=True, help="Remove all cached previews.")
+def opreviewcache(evict, clear):
+    """Show preview cache statistics."""
+    cache = preview_cache()
+    if clear:
+        click.echo("Removed {0:d} previews".format(cache.clear()))
+    elif evict:
+        click.echo("Evicted {0:d} previews".format(cache.evict()))
+    stats = cache.stats()
+    lookups = stats['hits'] + stats['misses']
+    click.echo("Hits: {0:d}".format(stats['hits']))
+    click.echo("Misses: {0:d}".format(stats['misses']))
+    click.echo("Hit rate: {0:.1%}".format(stats['hits'] / lookups if lookups else 0.0))
+    click.echo("Evictions: {0:d}".format(stats['evictions']))
+    budget = "unlimited" if cache.budget is None else "{0:.1f} MB".format(cache.budget / 1e6)
+    click.echo("Size: {0:.1f} MB of {1:s}".format(stats['size'] / 1e6, budget))
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming checksums of data files.
+"""
+
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+
+from .application import app, db
+from .model import DataFile
+from .transport import is_local, mounted_path
+
+__all__ = ['file_checksum', 'checksum_files', 'overify', 'CHUNKSIZE', 'DIGEST_SIZE']
+
+#: Size of the reads used to hash a file.
+CHUNKSIZE = 4 * 1024 * 1024
+
+#: Size of the BLAKE2b digest, in bytes.
+DIGEST_SIZE = 32
+
+def file_checksum(path, chunksize=CHUNKSIZE):
+    """The hex BLAKE2b digest of a file, read in chunks into a single reused buffer."""
+    digest = hashlib.blake2b(digest_size=DIGEST_SIZE)
+    buffer = bytearray(chunksize)
+    view = memoryview(buffer)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            digest.update(view[:n])
+    return digest.hexdigest()
+
+def checksum_files(paths, threads=4, chunksize=CHUNKSIZE):
+    """Iterate over (path, checksum, error) for each path, hashing in ``threads`` threads.
+
+    Hashing releases the GIL, so threads overlap reading and hashing several files.
+    """
+    def _checksum(path):
+        try:
+            return path, file_checksum(path, chunksize), None
+        except OSError as e:
+            return path, None, e
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        for result in executor.map(_checksum, paths):
+            yield result
+
+def _current(datafile):
+    """Whether a file's checksum is still current, i.e. the file wasn't rewritten since it was hashed."""
+    try:
+        return datafile.current_checksum() is not None
+    except OSError:
+        return False
+
+@app.cli.command()
+@click.option('--jobs', '-j', type=int, default=4, help="Number of threads used to checksum files.")
+@click.option('--update', is_flag=True, help="Record checksums for files which don't have one.")
+@click.option('--duplicates', is_flag=True, help="List files with the same contents.")
+def overify(jobs, update, duplicates):
+    """Verify data files against their checksums."""
+    datafiles = {}
+    for datafile in DataFile.query.order_by(DataFile.filename):
+        # Paths are found without stat-ing files, so missing files are counted below.
+        path = datafile.filename if is_local(datafile.host) else mounted_path(datafile.host, datafile.filename)
+        if path is not None:
+            datafiles[path] = datafile
+    counts = dict(verified=0, mismatched=0, changed=0, missing=0, updated=0)
+    for path, checksum, error in checksum_files(list(datafiles), threads=jobs):
+        datafile = datafiles[path]
+        if error is not None:
+            click.echo("Missing: '{0:s}' {1!r}".format(datafile.filename, error))
+            counts['missing'] += 1
+        elif datafile.checksum is None:
+            if update:
+                datafile.checksum = checksum
+                counts['updated'] += 1
+        elif datafile.checksum == checksum:
+            counts['verified'] += 1
+        elif not _current(datafile):
+            # The file was rewritten since it was imported, so it should be imported again.
+            click.echo("Changed: '{0:s}'".format(datafile.filename))
+            counts['changed'] += 1
+        else:
+            click.echo("Mismatch: '{0:s}'".format(datafile.filename))
+            counts['mismatched'] += 1
+    if update:
+        db.session.commit()
+    click.echo("Verified {verified:d}, mismatched {mismatched:d}, changed {changed:d}, missing {missing:d}, "
+               "updated {updated:d}".format(**counts))
+    if duplicates:
+        for checksum, filenames in sorted(DataFile.duplicates(db.session).items()):
+            click.echo("Duplicates: {0:s}".format(", ".join("'{0:s}'".format(filename) for filename in filenames)))
+    if counts['mismatched'] or counts['missing']:
+        raise click.ClickException("{0:d} files failed verification".format(counts['mismatched'] + counts['missing']))
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk insert and lookup helpers, keyed on natural keys.
+"""
+
+from sqlalchemy import inspect, func
+
+__all__ = ['upsert', 'resolve', 'supports_upsert']
+
+#: Maximum number of bound parameters to put in a single IN clause.
+CHUNKSIZE = 500
+
+def _dialect_name(session):
+    """Name of the dialect in use for a session."""
+    return session.get_bind().dialect.name
+
+def supports_upsert(session):
+    """Whether the session's database supports INSERT ... ON CONFLICT."""
+    return _dialect_name(session) in ('postgresql', 'sqlite')
+
+def _insert(session, table):
+    """Get a dialect-specific INSERT statement which supports ON CONFLICT."""
+    name = _dialect_name(session)
+    if name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif name == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        raise NotImplementedError("INSERT ... ON CONFLICT is not supported for {0:s}".format(name))
+    return insert(table)
+
+def _columns(model, names):
+    """Map attribute names to table columns."""
+    columns = inspect(model).columns
+    return [columns[name] for name in names]
+
+def upsert(session, model, rows, keys, update=True, fill=()):
+    """Insert rows of attributes into the table for model.
+
+    Rows whose natural ``keys`` (attribute names backed by a unique constraint)
+    already exist are updated with the new values if ``update`` is set, and left
+    alone otherwise. Attributes in ``fill`` are only updated where they are NULL.
+    """
+    mapper = inspect(model)
+    key_columns = _columns(model, keys)
+
+    # Rows are deduplicated on their natural key, as a single statement
+    # may not affect the same row twice.
+    table_rows = {}
+    for row in rows:
+        table_row = dict((mapper.columns[name].key, value) for name, value in row.items())
+        table_rows[tuple(table_row[c.key] for c in key_columns)] = table_row
+    if not table_rows:
+        return
+
+    stmt = _insert(session, model.__table__)
+    names = set(name for row in table_rows.values() for name in row)
+    fill = set(c.key for c in _columns(model, fill))
+    updates = {}
+    for name in names:
+        if name in set(c.key for c in key_columns):
+            continue
+        elif name in fill:
+            updates[name] = func.coalesce(model.__table__.c[name], stmt.excluded[name])
+        else:
+            updates[name] = stmt.excluded[name]
+    if update and updates:
+        stmt = stmt.on_conflict_do_update(index_elements=key_columns, set_=updates)
+    else:
+        stmt = stmt.on_conflict_do_nothing(index_elements=key_columns)
+    session.execute(stmt, list(table_rows.values()))
+
+def resolve(session, model, keys, values):
+    """Map natural key tuples to primary key identifiers, with one query per chunk of keys."""
+    key_columns = _columns(model, keys)
+    values = set(tuple(value) for value in values)
+    firsts = sorted(set(value[0] for value in values))
+    identifiers = {}
+    for i in range(0, len(firsts), CHUNKSIZE):
+        q = session.query(model.id, *key_columns).filter(key_columns[0].in_(firsts[i:i+CHUNKSIZE]))
+        for row in q:
+            key = tuple(row[1:])
+            if key in values:
+                identifiers[key] = row[0]
+    return identifiers
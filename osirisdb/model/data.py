@@ -5,11 +5,15 @@ from .base import Base
 import os
 import socket
 import h5py
+import numpy as np
 from astropy.io import fits
 from flask import current_app
-from sqlalchemy import Column, String, Integer, ForeignKey
+from sqlalchemy import Column, String, Integer, BigInteger, Float, ForeignKey, func
 
-from ..previews import Preview
+from ..previews import PREVIEW_VERSION, write_preview, write_thumbnail, write_collapsed, write_image, write_tile
+from ..cache import FileCache, preview_cache
+from ..spectra import write_spectrum
+from ..transport import TransportError, local_path, pinned_path, is_local, mounted_path
 
 __all__ = ['DataFile']
 
@@ -23,44 +27,204 @@ class DataFile(Base):
     
     kind = Column(String, doc="File kind.")
     host = Column(String, doc="Hostname which holds the data file.")
-    filename = Column(String, doc="File path")
+    filename = Column(String, doc="File path", unique=True)
+    
+    size = Column(BigInteger, doc="File size in bytes, when last imported.")
+    mtime = Column(Float, doc="File modification time, when last imported.")
+    inode = Column(BigInteger, doc="File inode number, when last imported.")
+    checksum = Column(String(64), index=True, doc="BLAKE2b checksum of the file contents, when last imported.")
     
     @property
     def basename(self):
         """Basename of the file."""
         return os.path.basename(self.filename)
     
+    @staticmethod
+    def parse_stat(stat):
+        """Parse the manifest attributes from the result of :func:`os.stat`."""
+        return dict(size=stat.st_size, mtime=stat.st_mtime, inode=stat.st_ino)
+    
+    @classmethod
+    def parse_filename(cls, filename):
+        """Parse a filename into the necessary attributes.
+        
+        Filenames are stored as absolute paths, which is how directory scans find them again.
+        """
+        filename = os.path.abspath(filename)
+        kind = KINDMAP[os.path.splitext(filename)[1]]
+        attrs = dict(host=socket.gethostname(), filename=filename, kind=kind)
+        attrs.update(cls.parse_stat(os.stat(filename)))
+        return attrs
+    
+    @classmethod
+    def manifest(cls, session, directory):
+        """The manifest of files under a directory, as a dictionary of filename to (size, mtime, inode)."""
+        prefix = os.path.join(directory, "")
+        q = session.query(cls.filename, cls.size, cls.mtime, cls.inode).filter(cls.filename.startswith(prefix, autoescape=True))
+        return dict((filename, (size, mtime, inode)) for filename, size, mtime, inode in q)
+    
     @classmethod
     def from_filename(cls, filename):
         """From a filename, create a data file record."""
-        kind = KINDMAP[os.path.splitext(filename)[1]]
-        return cls(host=socket.gethostname(), filename=filename, kind=kind)
+        return cls(**cls.parse_filename(filename))
+        
+    def version(self):
+        """The (size, mtime_ns) of the current contents of this file.
+        
+        Files on other hosts which aren't mounted here are not checked, and their
+        version is the one recorded when they were imported.
+        """
+        path = self.filename if is_local(self.host) else mounted_path(self.host, self.filename)
+        if path is not None:
+            stat = os.stat(path)
+            return stat.st_size, stat.st_mtime_ns
+        return self.size, int(round(self.mtime * 1e9)) if self.mtime is not None else None
+        
+    def current_checksum(self, version=None):
+        """The checksum of this file, if its (size, mtime_ns) ``version`` is still the one it was computed for."""
+        if self.checksum is None or self.size is None or self.mtime is None:
+            return None
+        size, mtime_ns = version or self.version()
+        # The recorded mtime is a float, which only has microsecond precision.
+        if size == self.size and abs(self.mtime * 1e9 - mtime_ns) < 1e3:
+            return self.checksum
+        return None
+        
+    @classmethod
+    def duplicates(cls, session):
+        """Groups of filenames with the same contents, by checksum."""
+        q = session.query(cls.checksum).filter(cls.checksum != None).group_by(cls.checksum).having(func.count(cls.id) > 1)
+        checksums = [checksum for checksum, in q]
+        groups = {}
+        q = session.query(cls.checksum, cls.filename).filter(cls.checksum.in_(checksums)).order_by(cls.filename)
+        for checksum, filename in q:
+            groups.setdefault(checksum, []).append(filename)
+        return groups
+        
+    def local_path(self):
+        """A path to this file on this host, fetching it from its own host if necessary."""
+        return local_path(self.host, self.filename, self.version())
+        
+    def pinned_path(self):
+        """A context manager for a path to this file on this host, which stays available until it exits."""
+        return pinned_path(self.host, self.filename, self.version())
         
     def open(self, mode="r"):
         """Open this file."""
-        if socket.gethostname() != self.host:
-            warnings.warn("Trying to open a file which might not be on this host.")
+        if 'r' not in mode and not is_local(self.host) and mounted_path(self.host, self.filename) is None:
+            raise TransportError("Can't modify '{0:s}' on {1:s}".format(self.filename, self.host))
+        filename = self.local_path()
         if self.kind == "fits":
-            return fits.open(self.filename, mode='readonly' if 'r' in mode else 'update')
+            return fits.open(filename, mode='readonly' if 'r' in mode else 'update')
         elif self.kind == "hdf5":
-            return h5py.File(self.filename, mode=mode)
+            return h5py.File(filename, mode=mode)
         else:
-            return open(self.filename, mode=mode)
+            return open(filename, mode=mode)
+        
+    def etag(self, stat=None):
+        """A strong entity tag for the current contents of this file, from its checksum if that is current."""
+        stat = stat or os.stat(self.local_path())
+        checksum = self.current_checksum((stat.st_size, stat.st_mtime_ns))
+        if checksum is not None:
+            return "b2-" + checksum
+        return "{0:x}-{1:x}".format(stat.st_size, stat.st_mtime_ns)
+        
+    def preview_key(self, variant="preview"):
+        """The cache key for a preview of this file, which changes when the file is rewritten.
         
-    def _preview_path(self):
-        """Construct the preview path."""
-        directory = current_app.config['DATAFILE_PREVIEW_CACHE']
-        path = os.path.join(directory,
-                            "{0:d}.{1:s}.preview.png".format(self.id, self.basename))
-        if not os.path.exists(directory):
-            os.makedirs(directory)
-        return path
+        Files with a current checksum are keyed on it, so copies of a file share their previews.
+        """
+        version = self.version()
+        checksum = self.current_checksum(version)
+        if checksum is not None:
+            return FileCache.key(checksum, PREVIEW_VERSION, variant)
+        return FileCache.key(self.id, self.filename, version, PREVIEW_VERSION, variant)
+        
+    def has_previews(self, sizes=()):
+        """Whether the preview and thumbnails at ``sizes`` of this file are all cached."""
+        cache = preview_cache()
+        keys = [self.preview_key()] + [self.preview_key("thumbnail-{0:d}".format(size)) for size in sizes]
+        return all(cache.contains(key, ".png") for key in keys)
+        
+    def cached_preview(self):
+        """Return the path to the preview of a file, if it has already been rendered."""
+        return preview_cache().get(self.preview_key(), ".png")
         
     def preview(self):
-        """Return the (host,path) to the preview of a file."""
-        path = self._preview_path()
-        if not os.path.exists(path):
-            figure = Preview[self.kind](self)
-            figure.savefig(path)
-        return path
-    
\ No newline at end of file
+        """Return the path to the preview of a file, rendering it if necessary.
+        
+        Concurrent requests for the same preview wait for a single render.
+        """
+        return preview_cache().get_or_put(self.preview_key(), lambda path: write_preview(self, path), ".png")
+        
+    def cached_thumbnail(self, size):
+        """Return the path to a thumbnail of a file, if it has already been rendered."""
+        return preview_cache().get(self.preview_key("thumbnail-{0:d}".format(size)), ".png")
+        
+    def thumbnail(self, size):
+        """Return the path to a thumbnail of a file, rendering it if necessary."""
+        key = self.preview_key("thumbnail-{0:d}".format(size))
+        return preview_cache().get_or_put(key, lambda path: write_thumbnail(self, size, path), ".png")
+        
+    def _collapse_method(self, method=None):
+        """The method used to collapse cubes, defaulting to the configured one."""
+        return method or current_app.config.get('PREVIEW_COLLAPSE_METHOD', 'median')
+        
+    def _collapsed_key(self, method, channels):
+        """The cache key for the cube in this file collapsed along wavelength."""
+        variant = "collapsed-{0:s}".format(method)
+        if channels is not None:
+            variant += "-{0:d}-{1:d}".format(*channels)
+        return self.preview_key(variant)
+        
+    def cached_collapsed(self, method=None, channels=None):
+        """Return the collapsed cube in this file, memory-mapped, if it has already been computed."""
+        path = preview_cache().get(self._collapsed_key(self._collapse_method(method), channels), ".npy")
+        if path is None:
+            return None
+        return np.load(path, mmap_mode='r')
+        
+    def collapsed(self, method=None, channels=None):
+        """Return the cube in this file, or a (start, stop) range of its channels, collapsed along wavelength.
+        
+        The collapsed image is cached, and returned memory-mapped.
+        """
+        method = self._collapse_method(method)
+        chunk_bytes = current_app.config.get('PREVIEW_COLLAPSE_CHUNK_BYTES', 64 * 1024 * 1024)
+        key = self._collapsed_key(method, channels)
+        path = preview_cache().get_or_put(key, lambda path: write_collapsed(self, path, method, chunk_bytes, channels), ".npy")
+        return np.load(path, mmap_mode='r')
+        
+    def _channel_image_key(self, channels, size, method):
+        """The cache key for an image of a range of channels of the cube in this file."""
+        return self.preview_key("channels-{0:d}-{1:d}-{2:s}-{3:d}".format(channels[0], channels[1], method, size))
+        
+    def cached_channel_image(self, channels, size, method=None):
+        """Return the path to an image of a range of channels of the cube in this file, if it has already been rendered."""
+        return preview_cache().get(self._channel_image_key(channels, size, self._collapse_method(method)), ".png")
+        
+    def channel_image(self, channels, size, method=None):
+        """Return the path to an image of a (start, stop) range of channels of the cube in this file."""
+        method = self._collapse_method(method)
+        key = self._channel_image_key(channels, size, method)
+        return preview_cache().get_or_put(key, lambda path: write_image(self.collapsed(method, channels), size, path), ".png")
+        
+    def _tile_key(self, z, x, y, channels, method):
+        """The cache key for a tile of the image pyramid of the cube in this file."""
+        return self.preview_key("tile-{0:d}-{1:d}-{2:d}-{3!r}-{4:s}".format(z, x, y, channels, method))
+        
+    def cached_tile(self, z, x, y, channels=None, method=None):
+        """Return the path to a tile of the image pyramid of the cube in this file, if it has already been rendered."""
+        return preview_cache().get(self._tile_key(z, x, y, channels, self._collapse_method(method)), ".png")
+        
+    def tile(self, z, x, y, channels=None, method=None):
+        """Return the path to a tile of the image pyramid of the cube in this file, or of a range of its channels."""
+        method = self._collapse_method(method)
+        return preview_cache().get_or_put(self._tile_key(z, x, y, channels, method),
+                                          lambda path: write_tile(self.collapsed(method, channels), z, x, y, path), ".png")
+        
+    def spectrum(self, x, y, r=0.0):
+        """Return the spectrum summed within ``r`` pixels of spaxel (x, y) of the cube in this file, from the cache if possible."""
+        key = self.preview_key("spectrum-{0:d}-{1:d}-{2!r}".format(x, y, float(r)))
+        path = preview_cache().get_or_put(key, lambda path: write_spectrum(self, x, y, r, path), ".npy")
+        return np.load(path)
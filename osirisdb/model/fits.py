@@ -3,14 +3,191 @@
 Tools to handle FITS files.
 """
 
+import json
+import zlib
+import difflib
+
+import numpy as np
 from sqlalchemy import Column
-from sqlalchemy.types import TypeDecorator, VARCHAR
+from sqlalchemy.types import TypeDecorator, LargeBinary, VARCHAR
 from astropy.io import fits
+import astropy.units as u
 from sqlalchemy import inspect
 
 from ..application import db
 
-__all__ = ['FHColumn', 'FHType']
+__all__ = ['FHColumn', 'FHType', 'TextFHType', 'LazyHeader', 'PrimaryHeader', 'read_primary_header',
+           'keyword_values', 'keyword_text', 'keyword_candidates',
+           'CompressedJSON', 'header_delta', 'header_delta_keywords', 'apply_header_delta']
+
+BLOCKSIZE = 2880
+CARDSIZE = 80
+
+class NonStandardHeader(Exception):
+    """Raised when a header can't be handled by the minimal reader."""
+    pass
+
+def _parse_card(card):
+    """Parse the value and comment of a single FITS card image."""
+    if card[8:10] != '= ':
+        raise NonStandardHeader("Card has no value indicator: {0!r}".format(card))
+    text = card[10:].lstrip()
+    if text.startswith("'"):
+        parts = []
+        start = 1
+        while True:
+            end = text.find("'", start)
+            if end == -1:
+                raise NonStandardHeader("Unterminated string: {0!r}".format(card))
+            if text[end+1:end+2] == "'":
+                parts.append(text[start:end+1])
+                start = end + 2
+                continue
+            parts.append(text[start:end])
+            break
+        value = "".join(parts).rstrip()
+        if value.endswith("&"):
+            raise NonStandardHeader("Long string values are not supported: {0!r}".format(card))
+        comment = text[end+1:].partition("/")[2]
+    else:
+        text, _, comment = text.partition("/")
+        text = text.strip()
+        if text == "T":
+            value = True
+        elif text == "F":
+            value = False
+        elif text == "":
+            value = None
+        else:
+            try:
+                value = int(text)
+            except ValueError:
+                try:
+                    value = float(text.replace("D", "E"))
+                except ValueError:
+                    raise NonStandardHeader("Can't parse value: {0!r}".format(card))
+    return value, comment.strip()
+
+class PrimaryHeader(object):
+    """A minimal, read-only FITS primary header.
+    
+    Only the requested keywords are decoded, but the raw header text is kept,
+    so this can be stored in an :class:`FHType` column like a full header.
+    """
+    
+    def __init__(self, raw, keywords):
+        super(PrimaryHeader, self).__init__()
+        self._raw = raw
+        self._values = {}
+        self.comments = {}
+        for i in range(0, len(raw), CARDSIZE):
+            card = raw[i:i+CARDSIZE]
+            keyword = card[:8].rstrip()
+            if keyword == "END":
+                break
+            if keyword in keywords and keyword not in self._values:
+                self._values[keyword], self.comments[keyword] = _parse_card(card)
+        
+    def __contains__(self, key):
+        return key in self._values
+    
+    def __getitem__(self, key):
+        return self._values[key]
+    
+    def get(self, key, default=None):
+        """Get a keyword value."""
+        return self._values.get(key, default)
+    
+    def items(self):
+        """Iterate over (keyword, value) for every card, parsing each one."""
+        for i in range(0, len(self._raw), CARDSIZE):
+            card = self._raw[i:i+CARDSIZE]
+            keyword = card[:8].rstrip()
+            if keyword == "END":
+                break
+            try:
+                value, comment = _parse_card(card)
+            except NonStandardHeader:
+                continue
+            yield keyword, value
+    
+    def tostring(self):
+        """The raw header text, as :meth:`astropy.io.fits.Header.tostring` would produce."""
+        return self._raw
+    
+    def to_header(self):
+        """Parse this into a full :class:`astropy.io.fits.Header`."""
+        return fits.Header.fromstring(self._raw)
+
+def keyword_values(header):
+    """All of the keyword values in a header which can be stored as JSON.
+    
+    Commentary cards are skipped, and the first card wins for repeated keywords.
+    """
+    values = {}
+    for keyword, value in header.items():
+        if keyword in ('', 'COMMENT', 'HISTORY') or keyword in values:
+            continue
+        if isinstance(value, (bool, int, float, str)):
+            values[keyword] = value
+    return values
+
+def keyword_text(value):
+    """A canonical text form of a keyword value, for indexing."""
+    if isinstance(value, bool):
+        return 'T' if value else 'F'
+    if isinstance(value, (int, float)):
+        return repr(float(value))
+    return str(value).rstrip()
+
+def keyword_candidates(text):
+    """The keyword values which a string (e.g. from a URL) could mean."""
+    candidates = [text]
+    if text in ('T', 'F'):
+        candidates.append(text == 'T')
+    try:
+        candidates.append(int(text))
+    except ValueError:
+        try:
+            candidates.append(float(text))
+        except ValueError:
+            pass
+    return candidates
+
+def _read_raw_header(filename):
+    """Read the 2880-byte blocks of a primary header, up to the END card."""
+    blocks = []
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(BLOCKSIZE)
+            if len(block) != BLOCKSIZE:
+                raise NonStandardHeader("File ended before the END card.")
+            if not blocks and not block.startswith(b"SIMPLE  =                    T"):
+                raise NonStandardHeader("Not a standard FITS file.")
+            blocks.append(block)
+            if any(block[i:i+8] == b"END     " for i in range(0, BLOCKSIZE, CARDSIZE)):
+                break
+    try:
+        return b"".join(blocks).decode('ascii')
+    except UnicodeDecodeError:
+        raise NonStandardHeader("Header contains non-ASCII characters.")
+
+def read_primary_header(filename, keywords):
+    """Read the primary header of a FITS file, decoding only the given keywords.
+    
+    Anything the minimal reader doesn't understand falls back to astropy.
+    """
+    try:
+        return PrimaryHeader(_read_raw_header(filename), frozenset(keywords))
+    except NonStandardHeader:
+        return fits.getheader(filename)
+
+#: NumPy types used for columnar header values, by python type.
+DTYPES = {
+    int : np.int64,
+    float : np.float64,
+    bool : np.bool_,
+}
 
 class FHColumn(Column):
     """A column which supports operating on a FITS Header."""
@@ -19,44 +196,273 @@ class FHColumn(Column):
         info = kwargs.setdefault('info', {})
         info['FITS.header.key'] = key
         super(FHColumn, self).__init__(*args, **kwargs)
-
+    
+    @property
+    def converter(self):
+        """Convert a header value to the column value."""
+        return self.type.python_type
+    
+    @property
+    def array_converter(self):
+        """Convert a sequence of header values to an array of column values."""
+        if hasattr(self.type, 'python_array'):
+            return self.type.python_array
+        dtype = DTYPES.get(self.type.python_type, object)
+        def converter(values):
+            mask = np.array([value is None for value in values], dtype=bool)
+            data = [None if value is None else self.type.python_type(value) for value in values]
+            if dtype is not object:
+                data = [dtype(0) if value is None else value for value in data]
+            return np.ma.masked_array(np.array(data, dtype=dtype), mask=mask)
+        return converter
+    
     def parse_header(self, header):
         """Parse a FITS Header, and return the column value."""
         key = self.info['FITS.header.key']
         value = header.get(key, None)
         if value is None:
             return value
-        return self.type.python_type(value)
+        return self.converter(value)
         
     
+class LazyHeader(object):
+    """A FITS header, which is only decompressed and parsed on first use.
+    
+    The parsed :class:`astropy.io.fits.Header` is cached, and attribute
+    access is passed through to it.
+    """
+    
+    def __init__(self, compressed=None, text=None):
+        super(LazyHeader, self).__init__()
+        self._compressed = compressed
+        self._text = text
+        self._header = None
+        
+    @classmethod
+    def from_string(cls, value):
+        """Make a lazy header from the header text."""
+        return cls(text=value)
+    
+    @property
+    def compressed(self):
+        """The compressed header text."""
+        if self._compressed is None:
+            self._compressed = zlib.compress(self._text.encode('ascii'))
+        return self._compressed
+    
+    @property
+    def header(self):
+        """The parsed header."""
+        if self._header is None:
+            self._header = fits.Header.fromstring(self.tostring())
+        return self._header
+    
+    def tostring(self):
+        """The header text."""
+        if self._text is None:
+            self._text = zlib.decompress(self._compressed).decode('ascii')
+        return self._text
+    
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.header, name)
+        
+    def __getitem__(self, key):
+        return self.header[key]
+    
+    def __contains__(self, key):
+        return key in self.header
+    
+    def __iter__(self):
+        return iter(self.header)
+    
+    def __len__(self):
+        return len(self.header)
+    
+    def __repr__(self):
+        return repr(self.header)
+    
 class FHType(TypeDecorator):
-    """A FITS header type"""
+    """A FITS header type, stored compressed."""
+    
+    impl = LargeBinary
+    cache_ok = True
+    
+    def process_bind_param(self, value, dialect):
+        if isinstance(value, LazyHeader):
+            value = value.compressed
+        elif value is not None:
+            value = zlib.compress(value.tostring().encode('ascii'))
+        return value
+    
+    def process_result_value(self, value, dialect):
+        if value is not None:
+            value = LazyHeader(bytes(value))
+        return value
+
+class TextFHType(TypeDecorator):
+    """A FITS header type, stored as text by earlier versions."""
     
     impl = VARCHAR
+    cache_ok = True
     
     def process_bind_param(self, value, dialect):
         if value is not None:
             value = value.tostring()
+        return value
+    
+    def process_result_value(self, value, dialect):
+        if value is not None:
+            value = LazyHeader.from_string(value)
+        return value
 
+class CompressedJSON(TypeDecorator):
+    """A JSON document, stored compressed."""
+    
+    impl = LargeBinary
+    cache_ok = True
+    
+    def process_bind_param(self, value, dialect):
+        if value is not None:
+            value = zlib.compress(json.dumps(value).encode('utf-8'))
         return value
     
     def process_result_value(self, value, dialect):
         if value is not None:
-            value = fits.Header.fromstring(value)
+            value = json.loads(zlib.decompress(bytes(value)).decode('utf-8'))
         return value
 
+def header_cards(header):
+    """The card images of a header, up to the END card."""
+    text = header.tostring()
+    cards = []
+    for i in range(0, len(text), CARDSIZE):
+        card = text[i:i+CARDSIZE]
+        if card[:8].rstrip() == "END":
+            break
+        cards.append(card)
+    while cards and not cards[-1].strip():
+        cards.pop()
+    return cards
+
+def header_delta(base, header):
+    """The difference between a header and a shared base header.
+    
+    The delta is an ordered edit script: ``['=', start, stop]`` copies a run of
+    base cards, and ``['+', cards]`` inserts cards, so card order (including
+    CONTINUE, COMMENT and HISTORY cards) is kept exactly. Without a base, the
+    delta holds every card of the header.
+    """
+    cards = header_cards(header)
+    if base is None:
+        return {'cards': cards}
+    base_cards = header_cards(base)
+    script = []
+    matcher = difflib.SequenceMatcher(None, base_cards, cards, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            script.append(['=', i1, i2])
+        elif j2 > j1:
+            script.append(['+', cards[j1:j2]])
+    return {'script': script}
+
+def header_delta_keywords(base, delta):
+    """The keywords of cards which a delta adds, changes or removes relative to the base header."""
+    if 'cards' in delta:
+        return set(card[:8].rstrip() for card in delta['cards'])
+    base_cards = header_cards(base) if base is not None else []
+    kept = [False] * len(base_cards)
+    keywords = set()
+    for op in delta['script']:
+        if op[0] == '=':
+            kept[op[1]:op[2]] = [True] * (op[2] - op[1])
+        else:
+            keywords.update(card[:8].rstrip() for card in op[1])
+    keywords.update(card[:8].rstrip() for card, used in zip(base_cards, kept) if not used)
+    return keywords
+
+def apply_header_delta(base, delta):
+    """Reconstruct a header from a shared base header and a delta."""
+    if 'cards' in delta:
+        cards = list(delta['cards'])
+    else:
+        base_cards = header_cards(base)
+        cards = []
+        for op in delta['script']:
+            if op[0] == '=':
+                cards.extend(base_cards[op[1]:op[2]])
+            else:
+                cards.extend(op[1])
+    cards.append("END".ljust(CARDSIZE))
+    text = "".join(cards)
+    return LazyHeader.from_string(text.ljust(-(-len(text) // BLOCKSIZE) * BLOCKSIZE))
+
 class FHMixin(db.Model):
     """A base class for FITS-Header based data objects."""
     
     __abstract__ = True
     
+    #: Header keywords used by ``parse_header`` in addition to those declared by :class:`FHColumn`.
+    _extra_header_keywords = ()
+    
+    @classmethod
+    def header_keywords(cls):
+        """The set of header keywords needed to parse a header."""
+        keywords = set()
+        for name, col in inspect(cls).columns.items():
+            if hasattr(col, 'parse_header'):
+                keywords.add(col.info['FITS.header.key'])
+        for klass in cls.__mro__:
+            keywords.update(klass.__dict__.get('_extra_header_keywords', ()))
+        return keywords
+    
+    @classmethod
+    def _cached_plan(cls, kind, factory):
+        """Build a plan once per class, and cache it on the class itself."""
+        attribute = '_{0:s}_plan'.format(kind)
+        plan = cls.__dict__.get(attribute, None)
+        if plan is None:
+            plan = tuple((name, col.info['FITS.header.key'], factory(col))
+                         for name, col in inspect(cls).columns.items() if hasattr(col, 'parse_header'))
+            setattr(cls, attribute, plan)
+        return plan
+    
+    @classmethod
+    def header_plan(cls):
+        """The extraction plan, a tuple of (attribute, keyword, converter)."""
+        return cls._cached_plan('header', lambda col: col.converter)
+    
+    @classmethod
+    def header_array_plan(cls):
+        """The columnar extraction plan, a tuple of (attribute, keyword, array converter)."""
+        return cls._cached_plan('header_array', lambda col: col.array_converter)
+    
     @classmethod
     def parse_header(cls, header):
         """Parse a FITS Header"""
         attrs = {}
-        for name, col in inspect(cls).columns.items():
-            if hasattr(col, 'parse_header'):
-                attrs[name] = col.parse_header(header)
+        for name, key, converter in cls.header_plan():
+            value = header.get(key, None)
+            attrs[name] = None if value is None else converter(value)
         return attrs
     
-    
\ No newline at end of file
+    @classmethod
+    def parse_headers(cls, headers):
+        """Parse a sequence of FITS headers into columnar arrays, one per attribute."""
+        columns = {}
+        for name, key, converter in cls.header_array_plan():
+            columns[name] = converter([header.get(key, None) for header in headers])
+        return columns
+    
+    @classmethod
+    def rows_from_columns(cls, columns):
+        """Convert columnar arrays from ``parse_headers`` into a list of attribute dictionaries."""
+        values = {}
+        for name, column in columns.items():
+            if isinstance(column, u.Quantity):
+                values[name] = [None if np.isnan(value) else value for value in column]
+            else:
+                values[name] = column.tolist()
+        length = max(len(column) for column in values.values()) if values else 0
+        return [dict((name, column[i]) for name, column in values.items()) for i in range(length)]
@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+"""
+Named locks which are held until the end of the current transaction.
+
+On PostgreSQL these are transaction-level advisory locks. Elsewhere, a row
+in the lock table is written, which holds the row (or on SQLite, the whole
+database) until the transaction ends.
+"""
+
+import hashlib
+import datetime
+
+from sqlalchemy import Column, String, DateTime, text
+
+from .base import Base
+from .bulk import upsert, supports_upsert
+
+__all__ = ['Lock', 'acquire_locks']
+
+class Lock(Base):
+    """A named lock."""
+    
+    name = Column(String, doc="Lock name.", unique=True)
+    acquired = Column(DateTime, doc="When this lock was last acquired.", default=datetime.datetime.now)
+    
+
+def lock_key(name):
+    """A signed 64-bit advisory lock key for a lock name."""
+    digest = hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+def acquire_locks(session, names):
+    """Acquire named locks for the rest of the transaction.
+    
+    Locks are always acquired in sorted order, so that two processes can't deadlock.
+    """
+    names = sorted(set(names))
+    if not names:
+        return
+    
+    if session.get_bind().dialect.name == 'postgresql':
+        for name in names:
+            session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': lock_key(name)})
+        return
+    
+    now = datetime.datetime.now()
+    if supports_upsert(session):
+        upsert(session, Lock, [dict(name=name, acquired=now) for name in names], ['name'])
+        return
+    
+    for name in names:
+        lock = session.query(Lock).filter(Lock.name == name).with_for_update().one_or_none()
+        if lock is None:
+            lock = Lock(name=name)
+            session.add(lock)
+        lock.acquired = now
+        session.flush()
+    
@@ -3,6 +3,7 @@
 from sqlalchemy.types import TypeDecorator, Float
 from astropy.coordinates import Angle as apAngle
 import astropy.units as u
+import numpy as np
 
 class Quantity(TypeDecorator):
     """A quantity type"""
@@ -17,6 +18,10 @@ class Quantity(TypeDecorator):
         """Make this into a python type."""
         return u.Quantity(value, self.unit)
     
+    def python_array(self, values):
+        """Make a sequence of values into a quantity array, with NaN for missing values."""
+        return u.Quantity([np.nan if value is None else value for value in values], self.unit, dtype=float)
+    
     def process_bind_param(self, value, dialect):
         """Bind a parameter to the flaot value."""
         if value is not None:
@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
 from . import importer
+from . import watch
+from . import prerender
+from . import upgrade
 from . import models
 from . import views
 from . import controllers
\ No newline at end of file
@@ -3,66 +3,415 @@
 Tools to import FITS files from their headers.
 """
 
+import os
+import time
+import random
+import datetime
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+import attr
 import click
 
 from astropy.io import fits
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy import or_
+from sqlalchemy.orm import undefer, joinedload
 
-from .models import Dataset, SpecFrame
+from .models import Dataset, SpecFrame, ImportJournal
+from .models.observation import SpecFrameData
 from ..model import DataFile
+from ..model.bulk import upsert, resolve, supports_upsert
+from ..model.lock import acquire_locks
+from ..model.fits import read_primary_header, keyword_values, header_delta
+from ..checksum import file_checksum
 from ..application import app, db
 
-__all__ = ['import_osiris_fits', 'oimport']
+__all__ = ['ParsedHeader', 'read_osiris_header', 'read_osiris_headers', 'iter_osiris_headers',
+           'import_osiris_header', 'import_osiris_batch', 'record_imports', 'import_osiris_fits',
+           'import_osiris_files', 'scan_osiris_directory', 'oimport']
+
+#: Number of files read and parsed together by each worker.
+CHUNKSIZE = 64
+
+#: Number of attempts to import a batch which conflicts with a concurrent import.
+RETRIES = 5
+
+#: Keywords decoded when reading headers for import.
+HEADER_KEYWORDS = frozenset(Dataset.header_keywords() | SpecFrame.header_keywords())
+
+@attr.s
+class ParsedHeader(object):
+    """The parsed primary header of a single OSIRIS FITS file."""
+    filename = attr.ib()
+    header = attr.ib()
+    dataset = attr.ib()
+    frame = attr.ib()
+    keywords = attr.ib(default=None)
+    checksum = attr.ib(default=None)
+
+def read_osiris_header(filename):
+    """Read and parse the primary header of an OSIRIS fits file.
+
+    This never touches the database, so it is safe to call from worker processes.
+    """
+    primary_header = read_primary_header(filename, HEADER_KEYWORDS)
+    return ParsedHeader(filename=filename, header=primary_header,
+                        dataset=Dataset.parse_header(primary_header),
+                        frame=SpecFrame.parse_header(primary_header),
+                        keywords=keyword_values(primary_header))
+
+def _read_osiris_header_safe(filename):
+    """Read a header, returning (filename, parsed, error) so that errors are reported by the writer."""
+    try:
+        return (filename, read_osiris_header(filename), None)
+    except Exception as e:
+        return (filename, None, repr(e))
+
+def read_osiris_headers(filenames):
+    """Read and parse the primary headers of many OSIRIS fits files.
+
+    Headers are parsed together into columns, and (filename, parsed, error) is returned for each file.
+    """
+    results = []
+    headers = []
+    for filename in filenames:
+        try:
+            headers.append((filename, read_primary_header(filename, HEADER_KEYWORDS)))
+        except Exception as e:
+            results.append((filename, None, repr(e)))
+
+    try:
+        primary_headers = [header for filename, header in headers]
+        datasets = Dataset.rows_from_columns(Dataset.parse_headers(primary_headers))
+        frames = SpecFrame.rows_from_columns(SpecFrame.parse_headers(primary_headers))
+    except Exception:
+        # Fall back to one header at a time, so that errors are attributed to single files.
+        results.extend(_read_osiris_header_safe(filename) for filename, header in headers)
+    else:
+        for (filename, header), dataset, frame in zip(headers, datasets, frames):
+            parsed = ParsedHeader(filename=filename, header=header, dataset=dataset, frame=frame,
+                                  keywords=keyword_values(header))
+            results.append((filename, parsed, None))
+    return results
+
+def iter_osiris_headers(files, jobs=1):
+    """Iterate over (filename, parsed, error) for each file, reading headers in ``jobs`` processes."""
+    files = list(files)
+    jobs = max(jobs or 1, 1)
+
+    # Large chunks amortize the IPC overhead, but keep enough chunks to balance the load.
+    chunksize = max(1, min(CHUNKSIZE, len(files) // (jobs * 4)))
+    chunks = [files[i:i+chunksize] for i in range(0, len(files), chunksize)]
+    if jobs == 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            for result in read_osiris_headers(chunk):
+                yield result
+        return
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for results in pool.imap_unordered(read_osiris_headers, chunks):
+            for result in results:
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+def dataset_lock_name(attrs):
+    """The name of the lock held while importing frames to a dataset."""
+    return "osiris.dataset/{0!s}/{1!s}".format(attrs['date'], attrs['number'])
+
+def import_osiris_header(parsed, session):
+    """Import a parsed OSIRIS header to session."""
+    acquire_locks(session, [dataset_lock_name(parsed.dataset)])
+
+    # Create the dataset.
+    q = Dataset.query.filter_by(**parsed.dataset)
+    dataset = q.one_or_none()
+    if dataset is None:
+        dataset = Dataset(base_header=parsed.header, **parsed.dataset)
+        frame = None
+    else:
+        # Create the Frame.
+        frame_number = parsed.frame['number']
+        frame = SpecFrame.query.filter(SpecFrame.dataset == dataset, SpecFrame.number == frame_number).one_or_none()
+
+    if dataset.base_header is None:
+        dataset.base_header = parsed.header
+
+    if frame is None:
+        frame = SpecFrame(dataset=dataset, header=parsed.header, **parsed.frame)
+        session.add(frame)
+        session.flush()
+        SpecFrame.index_keywords(session, {frame.id: parsed.keywords})
+
+    # Add a datafile object for the file itself.
+    datafile = DataFile.query.filter(DataFile.filename == parsed.filename).one_or_none()
+    if datafile is None:
+        datafile = DataFile.from_filename(parsed.filename)
+        frame.dataframes.append(datafile)
+        session.add(datafile)
+    else:
+        for name, value in DataFile.parse_stat(os.stat(parsed.filename)).items():
+            setattr(datafile, name, value)
+    datafile.checksum = parsed.checksum
+
+    # Add them to the session.
+    dataset.sframes.append(frame)
+    session.add(dataset)
+
+def import_osiris_batch(parsed_headers, session):
+    """Import a batch of parsed OSIRIS headers to session.
+
+    Existing datasets, frames and data files are resolved with one query per
+    table, keyed on (date, SETNUM), (dataset, FRAMENUM) and filename, and
+    everything is written with bulk INSERT ... ON CONFLICT statements.
+    """
+    # Every dataset lock in the batch is taken at once, in sorted order, so that two
+    # batches touching the same datasets in a different order can't deadlock.
+    acquire_locks(session, [dataset_lock_name(parsed.dataset) for parsed in parsed_headers])
+    if not supports_upsert(session):
+        for parsed in parsed_headers:
+            import_osiris_header(parsed, session)
+        return
+
+    datasets = {}
+    for parsed in parsed_headers:
+        datasets[(parsed.dataset['date'], parsed.dataset['number'])] = dict(parsed.dataset, base_header=parsed.header)
+    upsert(session, Dataset, datasets.values(), ['date', 'number'], fill=['base_header'])
+    dataset_ids = resolve(session, Dataset, ['date', 'number'], datasets.keys())
+    base_headers = Dataset.base_headers(session, dataset_ids.values())
+
+    frames = {}
+    frame_keys = {}
+    for parsed in parsed_headers:
+        dataset_id = dataset_ids[(parsed.dataset['date'], parsed.dataset['number'])]
+        delta = header_delta(base_headers[dataset_id], parsed.header)
+        frame = dict(parsed.frame, header_delta=delta, legacy_header=None, dataset_id=dataset_id)
+        frame_keys[parsed.filename] = (dataset_id, frame['number'])
+        frames[frame_keys[parsed.filename]] = frame
+    upsert(session, SpecFrame, frames.values(), ['dataset_id', 'number'])
+    frame_ids = resolve(session, SpecFrame, ['dataset_id', 'number'], frames.keys())
+    SpecFrame.index_keywords(session, dict((frame_ids[frame_keys[parsed.filename]], parsed.keywords)
+                                           for parsed in parsed_headers))
+
+    datafiles = [dict(DataFile.parse_filename(parsed.filename), checksum=parsed.checksum) for parsed in parsed_headers]
+    upsert(session, DataFile, datafiles, ['filename'])
+    datafile_ids = resolve(session, DataFile, ['filename'], [(parsed.filename,) for parsed in parsed_headers])
+
+    links = [dict(specframe_id=frame_ids[frame_keys[parsed.filename]],
+                  datafile_id=datafile_ids[(parsed.filename,)]) for parsed in parsed_headers]
+    upsert(session, SpecFrameData, links, ['specframe_id', 'datafile_id'], update=False)
+
+def _import_batch_retry(batch, session, retries=RETRIES):
+    """Import a batch inside a savepoint, retrying when it conflicts with a concurrent import."""
+    for attempt in range(retries):
+        try:
+            with session.begin_nested():
+                import_osiris_batch(batch, session)
+            return
+        except (IntegrityError, OperationalError):
+            if attempt + 1 >= retries:
+                raise
+            # Back off, so that the conflicting import can finish and commit.
+            time.sleep(random.uniform(0.05, 0.1) * 2 ** attempt)
+
+def _import_batch(batch, session):
+    """Import a batch inside a savepoint, isolating failures to single files.
+
+    Returns a dictionary of errors by filename.
+    """
+    errors = {}
+    try:
+        _import_batch_retry(batch, session)
+    except Exception:
+        for parsed in batch:
+            try:
+                _import_batch_retry([parsed], session)
+            except Exception as e:
+                click.echo("Error: '{0:s}' {1!r}".format(parsed.filename, e))
+                errors[parsed.filename] = repr(e)
+    return errors
+
+def record_imports(session, statuses):
+    """Record the import status of files in the journal.
+
+    ``statuses`` maps each filename to the error raised while importing it, or None.
+    """
+    now = datetime.datetime.now()
+    rows = [dict(filename=filename, error=error, updated=now,
+                 status=ImportJournal.IMPORTED if error is None else ImportJournal.FAILED)
+            for filename, error in statuses.items()]
+    if supports_upsert(session):
+        upsert(session, ImportJournal, rows, ['filename'])
+        return
+
+    entries = ImportJournal.query.filter(ImportJournal.filename.in_(list(statuses)))
+    entries = dict((entry.filename, entry) for entry in entries)
+    for row in rows:
+        entry = entries.get(row['filename'], None) or ImportJournal()
+        for name, value in row.items():
+            setattr(entry, name, value)
+        session.add(entry)
+
+def _commit_batch(batch, statuses, session):
+    """Import a batch, record it in the journal, and commit.
+
+    Returns a dictionary of errors by filename.
+    """
+    statuses = dict(statuses)
+    statuses.update((parsed.filename, None) for parsed in batch)
+    statuses.update(_import_batch(batch, session))
+    record_imports(session, statuses)
+    session.commit()
+    # Committed objects aren't needed any more, this keeps the session small.
+    session.expunge_all()
+    return dict((filename, error) for filename, error in statuses.items() if error is not None)
 
 def import_osiris_fits(filename, session):
     """Import an OSIRIS fits file to session."""
+    import_osiris_header(read_osiris_header(os.path.abspath(filename)), session)
+
+def _checksum(filename):
+    """The checksum of a file, or None if it can't be read."""
+    try:
+        return file_checksum(filename)
+    except OSError as e:
+        click.echo("Error: checksum of '{0:s}' {1!r}".format(filename, e))
+        return None
+
+def import_osiris_files(files, session, jobs=1, batch_size=500, checksum_threads=4):
+    """Import OSIRIS fits files to session, committing each batch.
     
-    with fits.open(filename) as HDUs:
-        primary_header = HDUs[0].header
-        
-        # Create the dataset.
-        q = Dataset.query.filter_by(**Dataset.parse_header(primary_header))
-        dataset = q.one_or_none()
-        if dataset is None:
-            dataset = Dataset.from_header(primary_header)
-            frame = None
-        else:
-            # Create the Frame.
-            frame_number = int(primary_header['FRAMENUM'])
-            frame = SpecFrame.query.filter(SpecFrame.dataset == dataset, SpecFrame.number == frame_number).one_or_none()
-        
-        if frame is None:
-            frame = SpecFrame.from_header(primary_header, dataset=dataset)
-            session.add(frame)
-
-        
-        # Add a datafile object for the file itself.
-        datafile = DataFile.query.filter(DataFile.filename == filename).one_or_none()
-        if datafile is None:
-            datafile = DataFile.from_filename(filename)
-            frame.dataframes.append(datafile)
-            session.add(datafile)
-        
-        # Add them to the session.
-        dataset.sframes.append(frame)
-        session.add(dataset)
-        
-    
+    File checksums are computed in ``checksum_threads`` threads, while headers are read.
+    Returns a dictionary of errors by filename, for the files which failed to import.
+    """
+    # Files are imported by absolute path, so that they match the directory manifests.
+    files = [os.path.abspath(filename) for filename in files]
+    batch = []
+    errors = {}
+    failed = {}
+    with ThreadPoolExecutor(max_workers=max(checksum_threads, 1)) as hasher:
+        checksums = dict((filename, hasher.submit(_checksum, filename)) for filename in files)
+        for filename, parsed, error in iter_osiris_headers(files, jobs=jobs):
+            click.echo("Importing '{0:s}'".format(filename))
+            if error is not None:
+                click.echo("Error: {0:s}".format(error))
+                errors[filename] = error
+            else:
+                parsed.checksum = checksums[filename].result()
+                batch.append(parsed)
+            if len(batch) + len(errors) >= batch_size:
+                failed.update(_commit_batch(batch, errors, session))
+                batch = []
+                errors = {}
+        if batch or errors:
+            failed.update(_commit_batch(batch, errors, session))
+        for future in checksums.values():
+            future.cancel()
+    return failed
+
+def _walk_fits(directory, recursive=False):
+    """Iterate over (filename, stat) for the FITS files in a directory."""
+    for entry in os.scandir(directory):
+        if entry.is_dir(follow_symlinks=False):
+            if recursive:
+                yield from _walk_fits(entry.path, recursive=recursive)
+        elif entry.is_file() and entry.name.endswith(".fits"):
+            yield entry.path, entry.stat()
+
+def scan_osiris_directory(directory, session, recursive=False):
+    """Find the FITS files in a directory which are new or have changed since they were imported.
+
+    Files are compared to the (size, mtime, inode) manifest kept on each DataFile,
+    so unchanged files are never opened.
+    """
+    directory = os.path.abspath(directory)
+    manifest = DataFile.manifest(session, directory)
+    changed = []
+    for filename, stat in _walk_fits(directory, recursive=recursive):
+        if manifest.get(filename, None) != (stat.st_size, stat.st_mtime, stat.st_ino):
+            changed.append(filename)
+    return sorted(changed)
+
 @app.cli.command()
+@click.option('--jobs', '-j', type=int, default=1, help="Number of worker processes used to read headers.")
+@click.option('--batch-size', type=int, default=500, help="Number of files imported and committed per batch.")
+@click.option('--resume', is_flag=True, help="Skip files which have already been imported.")
+@click.option('--dir', 'directories', multiple=True, type=click.Path(exists=True, file_okay=False), help="Import new or changed files from a directory.")
+@click.option('--recursive', '-r', is_flag=True, help="Scan directories recursively.")
+@click.option('--checksum-threads', type=int, default=4, help="Number of threads used to checksum files.")
 @click.argument('files', nargs=-1, type=str)
-def oimport(files):
+def oimport(files, jobs, batch_size, resume, directories, recursive, checksum_threads):
     """Import OSIRIS data files."""
-    for filename in files:
-        click.echo("Importing '{0:s}'".format(filename))
-        try:
-            import_osiris_fits(filename, db.session)
-        except Exception as e:
-            click.echo("Error: {0!r}".format(e))
-    db.session.commit()
-    
+    files = [os.path.abspath(filename) for filename in files]
+    for directory in directories:
+        changed = scan_osiris_directory(directory, db.session, recursive=recursive)
+        click.echo("Found {0:d} new or changed files in '{1:s}'".format(len(changed), directory))
+        files.extend(changed)
+    if resume:
+        imported = ImportJournal.imported(db.session)
+        files = [filename for filename in files if filename not in imported]
+        click.echo("Resuming, {0:d} files left to import.".format(len(files)))
+    import_osiris_files(files, db.session, jobs=jobs, batch_size=batch_size, checksum_threads=checksum_threads)
+
+@app.cli.command()
+@click.option('--batch-size', type=int, default=500, help="Number of frames updated per batch.")
+def orederive(batch_size):
+    """Re-derive OSIRIS frame columns and keyword indexes from their stored headers."""
+    last = 0
+    while True:
+        q = SpecFrame.query.options(undefer('header_delta'), undefer('legacy_header'),
+                                    joinedload(SpecFrame.dataset).undefer('base_header'))
+        q = q.filter(SpecFrame.id > last, or_(SpecFrame.header_delta != None, SpecFrame.legacy_header != None))
+        frames = q.order_by(SpecFrame.id).limit(batch_size).all()
+        if not frames:
+            break
+        rows = SpecFrame.rows_from_columns(SpecFrame.parse_headers([frame.header for frame in frames]))
+        for frame, row in zip(frames, rows):
+            row['id'] = frame.id
+        last = frames[-1].id
+        db.session.bulk_update_mappings(SpecFrame, rows)
+        SpecFrame.index_keywords(db.session, dict((frame.id, keyword_values(frame.header)) for frame in frames))
+        db.session.commit()
+        click.echo("Updated {0:d} frames".format(len(rows)))
+
 @app.cli.command()
 def odelete():
     """Delete OSIRIS data frames from databaes"""
     db.session.query(Dataset).delete()
     db.session.query(SpecFrame).delete()
     db.session.commit()
+
+@app.cli.command()
+@click.option('--repeat', '-n', type=int, default=3, help="Number of timing repeats.")
+@click.argument('files', nargs=-1, type=str)
+def obenchheaders(files, repeat):
+    """Benchmark the minimal header reader against fits.open."""
+    
+    def read_astropy(filename):
+        with fits.open(filename) as HDUs:
+            primary_header = HDUs[0].header
+            return Dataset.parse_header(primary_header), SpecFrame.parse_header(primary_header)
+    
+    def read_minimal(filename):
+        parsed = read_osiris_header(filename)
+        return parsed.dataset, parsed.frame
+    
+    timings = {}
+    for name, reader in [('fits.open', read_astropy), ('minimal', read_minimal)]:
+        best = None
+        for i in range(repeat):
+            start = time.perf_counter()
+            for filename in files:
+                reader(filename)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best
+        click.echo("{0:>10s}: {1:8.3f}ms per file".format(name, 1e3 * best / max(len(files), 1)))
     
+    mismatched = [filename for filename in files if read_astropy(filename) != read_minimal(filename)]
+    for filename in mismatched:
+        click.echo("Mismatch: '{0:s}'".format(filename))
+    click.echo("Speedup: {0:.1f}x".format(timings['fits.open'] / timings['minimal']))
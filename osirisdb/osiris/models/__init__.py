@@ -1,3 +1,4 @@
 # -*- coding: utf-8 -*-
 from .observation import *
-from .logs import *
\ No newline at end of file
+from .logs import *
+from .journal import *
\ No newline at end of file
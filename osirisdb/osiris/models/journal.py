@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+
+from sqlalchemy import Column, Text, String, DateTime
+
+from ...model.base import Base
+
+__all__ = ['ImportJournal']
+
+class ImportJournal(Base):
+    """The import status of a single file."""
+    
+    IMPORTED = 'imported'
+    FAILED = 'failed'
+    
+    filename = Column(String, doc="File path", unique=True)
+    status = Column(String, doc="Import status, either 'imported' or 'failed'.")
+    error = Column(Text, doc="The error raised while importing this file.")
+    updated = Column(DateTime, doc="When this file was last imported.", default=datetime.datetime.now, onupdate=datetime.datetime.now)
+    
+    @classmethod
+    def imported(cls, session):
+        """The set of filenames which have already been imported."""
+        return set(filename for filename, in session.query(cls.filename).filter(cls.status == cls.IMPORTED))
+    
@@ -4,27 +4,85 @@ import datetime
 
 from copy import copy, deepcopy
 
-from sqlalchemy import Column, Text, String, Integer, Date, DateTime, Float, Boolean, ForeignKey
-from sqlalchemy import inspect
-from sqlalchemy.orm import relationship
+import json
 
+from sqlalchemy import Column, Text, String, Integer, Date, DateTime, Float, Boolean, ForeignKey, UniqueConstraint, Index
+from sqlalchemy import inspect, event, DDL, JSON, or_, cast, bindparam, func
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.orm import relationship, deferred, joinedload, subqueryload, object_session
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.ext.declarative import declared_attr
+
+import attr
+import numpy as np
 import astropy.units as u
 from astropy.time import Time
 from astropy import coordinates
 
 from ...model.positions import Angle, Quantity
 from ...model.base import Base
-from ...model.fits import FHColumn, FHType, FHMixin
+from ...model.target import Target
+from ...model.fits import FHColumn, FHType, TextFHType, FHMixin, CompressedJSON, keyword_text, keyword_candidates
+from ...model.fits import header_delta, header_delta_keywords, apply_header_delta
+from ...application import db
+
+__all__ = ['Dataset', 'DatasetSummary', 'SpecFrame', 'SpecFrameKeyword']
+
+def _itime0_seconds(header):
+    """ITIME0 in seconds when it is recorded in microseconds, otherwise NaN."""
+    try:
+        if "ITIME0" in header and "microseconds" in header.comments['ITIME0']:
+            return header['ITIME0'] * 1e-6
+    except KeyError:
+        pass
+    return np.nan
+
+def _radians(degrees):
+    """Convert a sequence of angles in degrees to radians."""
+    try:
+        return np.deg2rad(np.asarray(degrees, dtype=float))
+    except (TypeError, ValueError):
+        return coordinates.Angle(degrees, unit=u.deg).radian
 
-__all__ = ['Dataset', 'SpecFrame']
+def _datetimes(isot):
+    """Convert a sequence of ISOT strings to datetimes."""
+    try:
+        return np.array(isot, dtype='datetime64[us]')
+    except ValueError:
+        return np.array(Time(isot, format='isot').datetime, dtype='datetime64[us]')
+
+def _sorted(values):
+    """Sort distinct values, with None last."""
+    return sorted(set(values), key=lambda value: (value is None, value))
+
+@attr.s
+class DatasetSummary(object):
+    """A summary of the frames in a dataset."""
+    frames = attr.ib(default=0)
+    filters = attr.ib(default=attr.Factory(list))
+    scales = attr.ib(default=attr.Factory(list))
+    object_names = attr.ib(default=attr.Factory(list))
+    exposure = attr.ib(default=0.0 * u.second)
+    
+    @property
+    def object_name(self):
+        """The object name, if it is consistent across all frames."""
+        if len(self.object_names) == 1:
+            return self.object_names[0]
+        return None
 
 class Dataset(Base, FHMixin):
     """A single OSIRIS dataset."""
     
+    __table_args__ = (UniqueConstraint('date', 'number'),)
+    _extra_header_keywords = ('SETNUM', 'DATE-OBS', 'DATASET')
+    
     number = FHColumn(Integer, doc="Dataset Number", key="SETNUM")
     date = Column(Date, doc="UT Date of start of dataset.")
     dataset_name = FHColumn(String, doc="Dataset name from DDF.", key="DATASET")
     
+    base_header = deferred(Column(FHType, doc="FITS Header shared by the frames in this dataset."))
+    
     targets = relationship("Target", secondary="specframe", backref="datasets")
     
     def _add_name_to_target_choices(self, form):
@@ -49,13 +107,85 @@ class Dataset(Base, FHMixin):
         form.new_targetname.data = self.dataset_name
         return form
     
+    def varying_keywords(self):
+        """The header keywords which differ from the base header in any frame."""
+        keywords = set()
+        for frame in self.sframes:
+            if frame.header_delta is not None:
+                keywords.update(header_delta_keywords(self.base_header, frame.header_delta))
+        return keywords
+    
+    @classmethod
+    def base_headers(cls, session, identifiers):
+        """Get the base headers for datasets by id, with a single query."""
+        q = session.query(cls.id, cls.base_header).filter(cls.id.in_(list(identifiers)))
+        return dict((identifier, base_header) for identifier, base_header in q)
+    
     def object_name(self):
         """Return the object name, if it is consistent across all frames."""
-        names = set(frame.object_name for frame in self.sframes)
-        if len(names) == 1:
-            return names.pop()
-        else:
-            return None
+        return self.summary.object_name
+    
+    @classmethod
+    def summaries(cls, session, identifiers):
+        """Summarize the frames of datasets by id, with a single GROUP BY query."""
+        groups = {}
+        q = session.query(SpecFrame.dataset_id, SpecFrame.filter, SpecFrame.scale, SpecFrame.object_name,
+                          func.count(SpecFrame.id), func.sum(SpecFrame.integration_time, type_=Float))
+        q = q.filter(SpecFrame.dataset_id.in_(list(identifiers)))
+        q = q.group_by(SpecFrame.dataset_id, SpecFrame.filter, SpecFrame.scale, SpecFrame.object_name)
+        for row in q:
+            groups.setdefault(row[0], []).append(row[1:])
+        
+        summaries = {}
+        for identifier in identifiers:
+            rows = groups.get(identifier, [])
+            summaries[identifier] = DatasetSummary(
+                frames=sum(count for _, _, _, count, _ in rows),
+                filters=_sorted(filter for filter, _, _, _, _ in rows),
+                scales=_sorted(scale for _, scale, _, _, _ in rows),
+                object_names=_sorted(name for _, _, name, _, _ in rows),
+                exposure=sum(exposure or 0.0 for _, _, _, _, exposure in rows) * u.second)
+        return summaries
+    
+    @property
+    def summary(self):
+        """The summary of this dataset's frames, prefetched by :meth:`prefetch` or queried on first use."""
+        summary = getattr(self, '_summary', None)
+        if summary is None:
+            summary = self._summary = self.summaries(object_session(self), [self.id])[self.id]
+        return summary
+    
+    @classmethod
+    def prefetch(cls, datasets, frames=False):
+        """Load the summaries and targets of datasets, and their frames if ``frames`` is set,
+        with a constant number of queries.
+        """
+        datasets = list(datasets)
+        if not datasets:
+            return datasets
+        session = object_session(datasets[0])
+        identifiers = [dataset.id for dataset in datasets]
+        summaries = cls.summaries(session, identifiers)
+        
+        targets = {}
+        q = session.query(SpecFrame.dataset_id, Target).join(SpecFrame.target)
+        q = q.filter(SpecFrame.dataset_id.in_(identifiers)).distinct()
+        for identifier, target in q:
+            targets.setdefault(identifier, []).append(target)
+        
+        if frames:
+            sframes = {}
+            q = session.query(SpecFrame).filter(SpecFrame.dataset_id.in_(identifiers))
+            q = q.options(joinedload(SpecFrame.target), subqueryload(SpecFrame.dataframes)).order_by(SpecFrame.number)
+            for frame in q:
+                sframes.setdefault(frame.dataset_id, []).append(frame)
+        
+        for dataset in datasets:
+            dataset._summary = summaries[dataset.id]
+            set_committed_value(dataset, 'targets', targets.get(dataset.id, []))
+            if frames:
+                set_committed_value(dataset, 'sframes', sframes.get(dataset.id, []))
+        return datasets
     
     @classmethod
     def parse_header(cls, header):
@@ -66,20 +196,38 @@ class Dataset(Base, FHMixin):
         attrs['dataset_name'] = header.get("DATASET")
         return attrs
     
+    @classmethod
+    def parse_headers(cls, headers):
+        """Parse a sequence of headers into columnar arrays."""
+        columns = super(Dataset, cls).parse_headers(headers)
+        columns['date'] = np.array([header.get("DATE-OBS") for header in headers], dtype='datetime64[D]')
+        return columns
+    
     @classmethod
     def from_header(cls, header):
         """Make a new dataset object from a header."""
         attrs = cls.parse_header(header)
+        attrs['base_header'] = header
         return cls(**attrs)
 
 class Frame(Base, FHMixin):
     """Database row for a single OSIRIS frame."""
     
     __abstract__ = True
+    _extra_header_keywords = ('ITIME0', 'RA', 'DEC', 'DATE-OBS', 'UTC')
         
     number = FHColumn(Integer, doc="Frame Number", key="FRAMENUM")
     obstype = FHColumn(String, doc="Observation Type", key="OBSTYPE")
-    header = Column(FHType, doc="FITS Header")
+    
+    @declared_attr
+    def header_delta(cls):
+        """FITS Header cards which differ from the base header, only loaded when used."""
+        return deferred(Column(CompressedJSON, doc="FITS Header cards which differ from the base header."))
+    
+    @declared_attr
+    def legacy_header(cls):
+        """The full FITS Header, as stored by earlier versions until ``oupgradedb`` converts it."""
+        return deferred(Column('header', TextFHType, doc="FITS Header, from before header deltas."))
     
     integration_time = FHColumn(Quantity(u.second), doc="Integration time in seconds for each coadd.", key="ITIME")
     coadds = FHColumn(Integer, doc="Number of coadds per frame.", key="COADDS")
@@ -92,11 +240,36 @@ class Frame(Base, FHMixin):
     
     time = Column(DateTime, doc="UT time for observation.")
     
+    def _base_header(self):
+        """The shared header which this frame's header is stored relative to."""
+        return None
+    
+    @property
+    def header(self):
+        """FITS Header"""
+        if getattr(self, '_header', None) is None:
+            if self.header_delta is not None:
+                self._header = apply_header_delta(self._base_header(), self.header_delta)
+            else:
+                self._header = self.legacy_header
+        return getattr(self, '_header', None)
+    
+    @header.setter
+    def header(self, header):
+        self._header = header
+        self._update_header_delta()
+    
+    def _update_header_delta(self):
+        """Store the header relative to the base header."""
+        header = getattr(self, '_header', None)
+        self.header_delta = None if header is None else header_delta(self._base_header(), header)
+        self.legacy_header = None
+    
     def _format_keywords(self):
         """Format keywords"""
         keywords = []
         for name, col in inspect(self.__class__).columns.items():
-            if name != 'header':
+            if name not in ('header_delta', 'legacy_header'):
                 keywords.append("{}={!r}".format(name, getattr(self, name)))
         return ", ".join(keywords)
     
@@ -116,8 +289,22 @@ class Frame(Base, FHMixin):
         attrs['time'] = Time(time, format='isot').datetime
         return attrs
     
+    @classmethod
+    def parse_headers(cls, headers):
+        """Parse a sequence of headers into columnar arrays."""
+        columns = super(Frame, cls).parse_headers(headers)
+        itime0 = np.array([_itime0_seconds(header) for header in headers], dtype=float)
+        itime = columns['integration_time'].to_value(u.second)
+        columns['integration_time'] = np.where(np.isnan(itime0), itime, itime0) * u.second
+        columns['ra'] = _radians([header["RA"] for header in headers])
+        columns['dec'] = _radians([header["DEC"] for header in headers])
+        columns['time'] = _datetimes(["{0}T{1}".format(header["DATE-OBS"], header["UTC"]) for header in headers])
+        return columns
+    
 class SpecFrame(Frame):
     """Frame parts that apply to the spectral frame specifically."""
+    __table_args__ = (UniqueConstraint('dataset_id', 'number'),)
+    
     dataset_id = Column(Integer, ForeignKey("dataset.id"))
     dataset = relationship("Dataset", backref='sframes')
     
@@ -133,6 +320,55 @@ class SpecFrame(Frame):
     
     dataframes = relationship("DataFile", secondary="specframedata", backref="specframes")
     
+    keywords = deferred(Column(JSON().with_variant(JSONB(), 'postgresql'),
+                               doc="Header keyword values, indexed for searches on PostgreSQL."))
+    
+    @staticmethod
+    def _uses_jsonb(session):
+        """Whether header keywords are indexed as JSONB, or in the side table."""
+        return session.get_bind().dialect.name == 'postgresql'
+    
+    @classmethod
+    def index_keywords(cls, session, keywords):
+        """Index header keyword values, given as a dictionary of keyword values by frame id."""
+        if not keywords:
+            return
+        if cls._uses_jsonb(session):
+            table = cls.__table__
+            stmt = table.update().where(table.c.id == bindparam('_id')).values(keywords=bindparam('_keywords'))
+            session.execute(stmt, [{'_id': id, '_keywords': values} for id, values in keywords.items()])
+            return
+        
+        table = SpecFrameKeyword.__table__
+        session.execute(table.delete().where(table.c.specframe_id.in_(list(keywords))))
+        rows = [dict(specframe_id=id, key=key, value=keyword_text(value))
+                for id, values in keywords.items() for key, value in values.items()]
+        if rows:
+            session.execute(table.insert(), rows)
+    
+    @classmethod
+    def keyword_filter(cls, key, value, session=None):
+        """A filter for frames whose header keyword ``key`` has the value ``value``.
+        
+        String values (e.g. from a URL) also match numeric and logical header values.
+        """
+        session = session or db.session
+        key = key.upper()
+        candidates = keyword_candidates(value) if isinstance(value, str) else [value]
+        if cls._uses_jsonb(session):
+            return or_(*[cls.keywords.op('@>')(cast(json.dumps({key: candidate}), JSONB))
+                         for candidate in candidates])
+        texts = set(keyword_text(candidate) for candidate in candidates)
+        q = session.query(SpecFrameKeyword.specframe_id).filter(SpecFrameKeyword.key == key,
+                                                                SpecFrameKeyword.value.in_(texts))
+        return cls.id.in_(q)
+    
+    def _base_header(self):
+        """The shared header which this frame's header is stored relative to."""
+        if self.dataset is not None:
+            return self.dataset.base_header
+        return None
+    
     @classmethod
     def from_header(cls, header, dataset=None):
         """Make a new SpecFrame from the given header."""
@@ -146,6 +382,26 @@ class SpecFrame(Frame):
 class SpecFrameData(Base):
     """An association table for spectrum frame data files."""
     
+    __table_args__ = (UniqueConstraint('specframe_id', 'datafile_id'),)
+    
     specframe_id = Column(Integer, ForeignKey("specframe.id"))
     datafile_id = Column(Integer, ForeignKey("datafile.id"))
-        
\ No newline at end of file
+        
+
+class SpecFrameKeyword(Base):
+    """Header keyword values for spectrum frames, indexed where JSONB isn't available."""
+    
+    __table_args__ = (Index('ix_specframekeyword_key_value', 'key', 'value'),)
+    
+    specframe_id = Column(Integer, ForeignKey("specframe.id"), index=True)
+    key = Column(String, doc="Header keyword.")
+    value = Column(String, doc="Header value, in canonical text form.")
+    
+@event.listens_for(SpecFrame, 'before_insert')
+def _specframe_header_delta(mapper, connection, target):
+    """The dataset may not be known when the header is set, so compute the delta again before inserting."""
+    if getattr(target, '_header', None) is not None:
+        target._update_header_delta()
+
+event.listen(SpecFrame.__table__, 'after_create',
+             DDL("CREATE INDEX ix_specframe_keywords ON specframe USING gin (keywords jsonb_path_ops)").execute_if(dialect='postgresql'))
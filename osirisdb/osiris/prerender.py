@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""
+Render previews ahead of time, so that they are ready before anyone asks for them.
+"""
+
+import datetime
+import multiprocessing
+
+import click
+
+from .models import Dataset, SpecFrame
+from ..model import DataFile
+from ..previews import THUMBNAIL_SIZES
+from ..render import render_preview, preview_job
+from ..application import app
+
+__all__ = ['missing_previews', 'render_previews', 'opreview']
+
+def _parse_date(value):
+    """Parse a YYYY-MM-DD date."""
+    return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+
+def missing_previews(datafiles, sizes=THUMBNAIL_SIZES):
+    """Filter data files to those missing a cached preview or thumbnail."""
+    for datafile in datafiles:
+        try:
+            if datafile.has_previews(sizes):
+                continue
+        except OSError as e:
+            click.echo("Error: '{0:s}' {1!r}".format(datafile.filename, e))
+            continue
+        yield datafile
+
+def _render(job):
+    """Render the previews for one file, returning (filename, error)."""
+    attrs, sizes = job
+    try:
+        render_preview(attrs, sizes)
+    except Exception as e:
+        return attrs['filename'], e
+    return attrs['filename'], None
+
+def render_previews(datafiles, jobs=1, sizes=THUMBNAIL_SIZES):
+    """Render previews for data files in ``jobs`` processes, yielding (filename, error) as each finishes."""
+    work = [(preview_job(datafile), sizes) for datafile in datafiles]
+    if jobs <= 1:
+        for job in work:
+            yield _render(job)
+        return
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for result in pool.imap_unordered(_render, work):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+@app.cli.command()
+@click.option('--jobs', '-j', type=int, default=1, help="Number of worker processes used to render previews.")
+@click.option('--start', type=_parse_date, default=None, help="Render previews for datasets from this date (YYYY-MM-DD).")
+@click.option('--end', type=_parse_date, default=None, help="Render previews for datasets up to this date (YYYY-MM-DD).")
+@click.option('--dataset', 'datasets', type=int, multiple=True, help="Render previews for a dataset, by id.")
+@click.option('--all', 'all_files', is_flag=True, help="Render all missing previews.")
+def opreview(jobs, start, end, datasets, all_files):
+    """Render missing previews and thumbnails."""
+    if not (start or end or datasets or all_files):
+        raise click.UsageError("Give a date range, dataset ids, or --all.")
+    q = DataFile.query
+    if start or end or datasets:
+        q = q.join(DataFile.specframes).join(SpecFrame.dataset)
+        if start:
+            q = q.filter(Dataset.date >= start)
+        if end:
+            q = q.filter(Dataset.date <= end)
+        if datasets:
+            q = q.filter(Dataset.id.in_(datasets))
+    datafiles = list(missing_previews(q.distinct().order_by(DataFile.id)))
+    click.echo("Rendering previews for {0:d} files".format(len(datafiles)))
+    
+    failed = 0
+    for n, (filename, error) in enumerate(render_previews(datafiles, jobs=jobs), 1):
+        if error is not None:
+            failed += 1
+            click.echo("Error: '{0:s}' {1!r}".format(filename, error))
+        else:
+            click.echo("[{0:d}/{1:d}] '{2:s}'".format(n, len(datafiles), filename))
+    click.echo("Rendered {0:d} files, {1:d} failed".format(len(datafiles) - failed, failed))
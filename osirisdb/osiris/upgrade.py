@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""
+Upgrade a database created by earlier versions to the current schema.
+
+``db.create_all`` only creates missing tables, so columns, indexes and unique
+constraints added to existing tables are added here. Unique constraints are
+added as unique indexes, which SQLite can add to an existing table, and which
+back INSERT ... ON CONFLICT just as well. Every step is skipped when it has
+already been done, so the upgrade can be run again after an interruption.
+"""
+
+import click
+
+from sqlalchemy import inspect, and_, func, bindparam, text, UniqueConstraint
+from sqlalchemy.orm import undefer, joinedload
+from sqlalchemy.schema import CreateColumn
+
+from .models import Dataset, SpecFrame
+from .models.observation import SpecFrameData, SpecFrameKeyword
+from ..model import DataFile
+from ..application import app, db
+
+__all__ = ['add_columns', 'add_indexes', 'deduplicate', 'migrate_headers', 'oupgradedb']
+
+def add_columns(session, metadata):
+    """Add the columns of existing tables which are missing from the database, returning their names."""
+    connection = session.connection()
+    inspector = inspect(connection)
+    tables = set(inspector.get_table_names())
+    added = []
+    for table in metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = set(column['name'] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                ddl = CreateColumn(column).compile(dialect=connection.dialect)
+                session.execute(text("ALTER TABLE {0:s} ADD COLUMN {1!s}".format(table.name, ddl)))
+                added.append("{0:s}.{1:s}".format(table.name, column.name))
+    return added
+
+def _unique_columns(table):
+    """The column name tuples of the unique constraints of a table."""
+    return [tuple(column.name for column in constraint.columns)
+            for constraint in table.constraints if isinstance(constraint, UniqueConstraint)]
+
+def add_indexes(session, metadata):
+    """Add the indexes and unique constraints of existing tables which are missing from the database."""
+    connection = session.connection()
+    inspector = inspect(connection)
+    quote = connection.dialect.identifier_preparer.quote
+    added = []
+    for table in metadata.sorted_tables:
+        indexes = inspector.get_indexes(table.name)
+        names = set(index['name'] for index in indexes)
+        unique = set(tuple(index['column_names']) for index in indexes if index['unique'])
+        unique.update(tuple(constraint['column_names']) for constraint in inspector.get_unique_constraints(table.name))
+        for index in table.indexes:
+            if index.name not in names:
+                index.create(connection)
+                added.append(index.name)
+        for columns in _unique_columns(table):
+            if columns not in unique:
+                name = "uq_{0:s}_{1:s}".format(table.name, "_".join(columns))
+                session.execute(text("CREATE UNIQUE INDEX {0:s} ON {1:s} ({2:s})".format(
+                    quote(name), quote(table.name), ", ".join(quote(column) for column in columns))))
+                added.append(name)
+    return added
+
+def _duplicates(session, table, columns):
+    """Map the ids of rows which repeat the values of ``columns`` of an earlier row to the id of that row.
+
+    Rows with NULL in any of ``columns`` never conflict, so they are left alone.
+    """
+    columns = [table.c[name] for name in columns]
+    first = session.query(func.min(table.c.id).label('id'), *columns)
+    first = first.filter(and_(*[column != None for column in columns])).group_by(*columns).having(func.count() > 1).subquery()
+    q = session.query(table.c.id, first.c.id).join(first, and_(*[column == first.c[column.name] for column in columns]))
+    return dict(q.filter(table.c.id != first.c.id).all())
+
+def _repoint(session, column, replacements):
+    """Point a foreign key column at the rows which replace the rows it points at."""
+    if replacements:
+        stmt = column.table.update().where(column == bindparam('_old')).values({column.name: bindparam('_new')})
+        session.execute(stmt, [{'_old': old, '_new': new} for old, new in replacements.items()])
+
+def _delete(session, table, identifiers):
+    """Delete rows by id."""
+    if identifiers:
+        stmt = table.delete().where(table.c.id == bindparam('_id'))
+        session.execute(stmt, [{'_id': identifier} for identifier in identifiers])
+
+def _move_frames(session, replacements):
+    """Move frames to the datasets which replace theirs, keeping their headers.
+
+    Frame headers are stored relative to their dataset's base header, so they are
+    stored again relative to the new dataset's base header.
+    """
+    q = session.query(SpecFrame).options(undefer('header_delta'), joinedload(SpecFrame.dataset).undefer('base_header'))
+    for frame in q.filter(SpecFrame.dataset_id.in_(list(replacements)), SpecFrame.header_delta != None):
+        header = frame.header
+        frame.dataset = session.query(Dataset).get(replacements[frame.dataset_id])
+        frame.header = header
+    session.flush()
+    _repoint(session, SpecFrame.__table__.c.dataset_id, replacements)
+
+def deduplicate(session):
+    """Merge rows which repeat a natural key, so that its unique constraint can be added.
+
+    The row with the lowest id is kept, and references to the others are pointed at it.
+    Returns the number of rows removed from each table.
+    """
+    removed = {}
+
+    datasets = _duplicates(session, Dataset.__table__, ['date', 'number'])
+    _move_frames(session, datasets)
+    _delete(session, Dataset.__table__, datasets)
+    removed['dataset'] = len(datasets)
+
+    table = SpecFrame.__table__
+    frames = _duplicates(session, table, ['dataset_id', 'number'])
+    if frames:
+        # Targets assigned to a removed frame are kept, unless the remaining frame has its own.
+        targets = session.query(table.c.id, table.c.target_id).filter(table.c.id.in_(list(frames)), table.c.target_id != None)
+        stmt = table.update().where(and_(table.c.id == bindparam('_id'), table.c.target_id == None))
+        for old, target in targets.all():
+            session.execute(stmt.values(target_id=target), {'_id': frames[old]})
+        keywords = SpecFrameKeyword.__table__
+        session.execute(keywords.delete().where(keywords.c.specframe_id.in_(list(frames))))
+    _repoint(session, SpecFrameData.__table__.c.specframe_id, frames)
+    _delete(session, table, frames)
+    removed['specframe'] = len(frames)
+
+    datafiles = _duplicates(session, DataFile.__table__, ['filename'])
+    _repoint(session, SpecFrameData.__table__.c.datafile_id, datafiles)
+    _delete(session, DataFile.__table__, datafiles)
+    removed['datafile'] = len(datafiles)
+
+    associations = _duplicates(session, SpecFrameData.__table__, ['specframe_id', 'datafile_id'])
+    _delete(session, SpecFrameData.__table__, associations)
+    removed['specframedata'] = len(associations)
+    return removed
+
+def migrate_headers(session, batch_size=500):
+    """Convert frame headers stored in full into base headers and per-frame deltas, yielding the running total."""
+    total = 0
+    while True:
+        q = session.query(SpecFrame).options(undefer('legacy_header'), joinedload(SpecFrame.dataset).undefer('base_header'))
+        frames = q.filter(SpecFrame.legacy_header != None).order_by(SpecFrame.id).limit(batch_size).all()
+        if not frames:
+            break
+        for frame in frames:
+            if frame.dataset is not None and frame.dataset.base_header is None:
+                # Datasets imported before base headers existed use their first converted frame.
+                frame.dataset.base_header = frame.legacy_header
+            frame.header = frame.legacy_header
+        session.commit()
+        total += len(frames)
+        yield total
+
+@app.cli.command()
+@click.option('--batch-size', type=int, default=500, help="Number of frame headers converted per batch.")
+def oupgradedb(batch_size):
+    """Upgrade a database created by an earlier version to the current schema."""
+    db.create_all()
+
+    for name in add_columns(db.session, db.metadata):
+        click.echo("Added column {0:s}".format(name))
+    db.session.commit()
+
+    for table, count in sorted(deduplicate(db.session).items()):
+        if count:
+            click.echo("Removed {0:d} duplicate rows from {1:s}".format(count, table))
+    db.session.commit()
+
+    for name in add_indexes(db.session, db.metadata):
+        click.echo("Added index {0:s}".format(name))
+    if db.session.connection().dialect.name == 'postgresql':
+        if 'ix_specframe_keywords' not in set(index['name'] for index in inspect(db.session.connection()).get_indexes('specframe')):
+            db.session.execute(text("CREATE INDEX ix_specframe_keywords ON specframe USING gin (keywords jsonb_path_ops)"))
+            click.echo("Added index ix_specframe_keywords")
+    db.session.commit()
+
+    for total in migrate_headers(db.session, batch_size):
+        click.echo("Converted {0:d} frame headers".format(total))
@@ -1,15 +1,20 @@
 # -*- coding: utf-8 -*-
 from flask.views import MethodView
-from flask import render_template, redirect, g, jsonify
+from flask import render_template, redirect, g, jsonify, abort, current_app, Response, stream_with_context
 
 import datetime
+import functools
+import itertools
 
 from ..core import api
-from ..models import Dataset
+from ..models import Dataset, SpecFrame
+from ...model import DataFile
+from ...bundle import Member, stream_tar, stream_zip
+from ...transport import TransportError
 from ...views.targets import select_target_form
 from ...model.target import Target
 from ...views.base import ViewBase
-from ...views.archive import ArchiveView
+from ...views.archive import ArchiveView, archive_dates
 from ...application import db
 
 __all__ = ['DatasetView']
@@ -27,15 +32,105 @@ class DatasetView(DatasetBase, MethodView):
     def get(self, identifier=None, page=None):
         """Get the dataset view."""
         if identifier is None:
-            return render_template("datasets/list.html", datasets=self.get_paginate(page))
+            datasets = self.get_paginate(page)
+            Dataset.prefetch(datasets.items)
+            return render_template("datasets/list.html", datasets=datasets)
         return render_template("datasets/item.html", dataset=self.get_one(identifier))
 
-ArchiveView.register(api, 'dataset_archive', Dataset, 'datasets/', prefix='datasets/archive', modelcontextname='datasets')
+ArchiveView.register(api, 'dataset_archive', Dataset, 'datasets/', prefix='datasets/archive', modelcontextname='datasets',
+                     prefetch=functools.partial(Dataset.prefetch, frames=True))
 
 @api.route("datasets/page/<int:page>/raw")
 def dataset_raw(page=None):
     """Return the raw part of the dataset page."""
-    return render_template("datasets/_datasets.html", datasets=Dataset.query.order_by(Dataset.date).paginate(page, per_page=100))
+    datasets = Dataset.query.order_by(Dataset.date).paginate(page, per_page=100)
+    Dataset.prefetch(datasets.items)
+    return render_template("datasets/_datasets.html", datasets=datasets)
+
+def dataset_members(*criteria):
+    """The archive members for each distinct data file in the datasets matching criteria, grouped by date.
+    
+    Members are archived at their recorded size, and files on other hosts are only fetched when they are read.
+    """
+    q = db.session.query(DataFile, Dataset.date).join(DataFile.specframes).join(SpecFrame.dataset)
+    q = q.filter(*criteria).distinct().order_by(Dataset.date, DataFile.filename)
+    members, checksums = [], set()
+    for datafile, date in q:
+        try:
+            size, mtime_ns = datafile.version()
+        except FileNotFoundError:
+            continue
+        # Copies of the same file are only archived once, if their checksums are current.
+        checksum = datafile.current_checksum((size, mtime_ns))
+        if checksum is not None:
+            if checksum in checksums:
+                continue
+            checksums.add(checksum)
+        arcname = "{0:%Y-%m-%d}/{1:s}".format(date, datafile.basename)
+        if size is None:
+            # Without a recorded size, the file has to be fetched to start the archive.
+            try:
+                members.append(Member.from_path(arcname, datafile.local_path()))
+            except TransportError as e:
+                current_app.logger.error("Fetching {0!r} failed: {1!s}".format(datafile, e))
+                abort(502)
+        else:
+            members.append(Member(arcname, size, mtime_ns / 1e9 if mtime_ns is not None else None, datafile.pinned_path))
+    return members
+
+def _logged(stream, name):
+    """Pass through an archive stream, logging a file which can't be fetched partway through it."""
+    try:
+        for chunk in stream:
+            yield chunk
+    except (TransportError, OSError) as e:
+        current_app.logger.error("Archive {0:s} failed: {1!r}".format(name, e))
+        raise
+
+def bundle_response(members, name, kind):
+    """Stream the members as a tar or zip archive named name.
+    
+    The first member is opened before the response starts, so that a file which can't be
+    fetched gives a 502 response. Later failures can only end the stream.
+    """
+    if not members:
+        abort(404)
+    chunksize = current_app.config.get('ARCHIVE_CHUNK_SIZE', 4 * 1024 * 1024)
+    if kind == 'tar':
+        length, stream = stream_tar(members, chunksize)
+    else:
+        length, stream = None, stream_zip(members, chunksize)
+    try:
+        first = next(stream)
+    except TransportError as e:
+        current_app.logger.error("Archive {0:s} failed: {1!s}".format(name, e))
+        abort(502)
+    except FileNotFoundError:
+        abort(404)
+    
+    # Members are opened as the stream reaches them, which needs the application's configuration.
+    response = Response(stream_with_context(_logged(itertools.chain([first], stream), name)),
+                        mimetype='application/x-tar' if kind == 'tar' else 'application/zip', direct_passthrough=True)
+    if length is not None:
+        response.content_length = length
+    response.headers.add('Content-Disposition', 'attachment', filename="{0:s}.{1:s}".format(name, kind))
+    return response
+
+@api.route("datasets/<int:id>/download.<any(tar, zip):kind>")
+def download_dataset(id, kind):
+    """Download all the data files of a dataset as one archive."""
+    dataset = Dataset.query.get_or_404(id)
+    name = "osiris-{0:%Y%m%d}-{1:d}".format(dataset.date, dataset.number)
+    return bundle_response(dataset_members(Dataset.id == dataset.id), name, kind)
+
+@api.route("datasets/archive/<int:year>/download.<any(tar, zip):kind>")
+@api.route("datasets/archive/<int:year>/<int:month>/download.<any(tar, zip):kind>")
+@api.route("datasets/archive/<int:year>/<int:month>/<int:day>/download.<any(tar, zip):kind>")
+def download_dataset_archive(kind, year, month=None, day=None):
+    """Download all the data files of the datasets in a year, month or night as one archive."""
+    start, end = archive_dates(year, month, day)
+    name = "osiris-" + "-".join("{0:02d}".format(part) for part in (year, month, day) if part is not None)
+    return bundle_response(dataset_members(Dataset.date >= start, Dataset.date < end), name, kind)
 
 @api.route("datasets/<int:id>/target/", methods=('POST',))
 def set_dataset_target(id):
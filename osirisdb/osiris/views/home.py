@@ -7,4 +7,6 @@ from ..models import Dataset, OSIRISLog
 @api.route('')
 def home():
     """OSIRIS Home view."""
-    return render_template('osiris_home.html', datasets=Dataset.query.order_by(Dataset.date).paginate(), logs=OSIRISLog.query.all())
\ No newline at end of file
+    datasets = Dataset.query.order_by(Dataset.date).paginate()
+    Dataset.prefetch(datasets.items)
+    return render_template('osiris_home.html', datasets=datasets, logs=OSIRISLog.query.all())
\ No newline at end of file
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 from flask.views import MethodView
-from flask import render_template, redirect, g
+from flask import render_template, redirect, request, g
+from sqlalchemy.orm import subqueryload
 
 from ..core import api
 from ..models import SpecFrame
@@ -17,6 +18,14 @@ class SpecFrameBase(ViewBase):
     """
     model = SpecFrame
     
+    def get_many(self):
+        """Get the full index, filtered by header keywords given as ``hdr.KEY=value``."""
+        q = self.model.query.options(subqueryload(self.model.dataframes))
+        for arg, value in request.args.items(multi=True):
+            if arg.startswith("hdr."):
+                q = q.filter(self.model.keyword_filter(arg[len("hdr."):], value))
+        return q.all()
+    
 
 class SpecFrameView(SpecFrameBase, MethodView):
     """Method view to render the dataset."""
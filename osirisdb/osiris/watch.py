@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Watch the data directories of active observing logs, and import new files as they arrive.
+"""
+
+import os
+import time
+import datetime
+
+import attr
+import click
+
+from .models import OSIRISLog
+from .importer import import_osiris_files
+from ..model import DataFile
+from ..model.fits import BLOCKSIZE
+from ..application import app, db
+
+__all__ = ['DirectoryWatcher', 'active_directories', 'owatch']
+
+def active_directories(days=1):
+    """Data directories for the observing logs from the last few days."""
+    since = datetime.datetime.utcnow().date() - datetime.timedelta(days=days)
+    logs = OSIRISLog.query.filter(OSIRISLog.date >= since, OSIRISLog.data_directory != None)
+    return sorted(set(os.path.abspath(log.data_directory) for log in logs
+                      if log.data_directory and os.path.isdir(log.data_directory)))
+
+@attr.s
+class DirectoryWatcher(object):
+    """Poll directories for new FITS files, reporting each once it has been completely written.
+    
+    A file is complete once its size and modification time have not changed
+    for ``settle`` seconds, and it is a whole number of FITS blocks long.
+    """
+    
+    settle = attr.ib(default=1.0)
+    recursive = attr.ib(default=False)
+    _manifest = attr.ib(default=attr.Factory(dict), init=False)
+    _pending = attr.ib(default=attr.Factory(dict), init=False)
+    _failed = attr.ib(default=attr.Factory(dict), init=False)
+    _directories = attr.ib(default=attr.Factory(set), init=False)
+    
+    def watch(self, directory, session):
+        """Start watching a directory, ignoring files which have already been imported.
+        
+        Returns whether the directory is newly watched.
+        """
+        if directory in self._directories:
+            return False
+        self._directories.add(directory)
+        self._manifest.update(DataFile.manifest(session, directory))
+        return True
+        
+    def _scan(self, directory):
+        """Iterate over (filename, stat) for the FITS files in a directory."""
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            return
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if self.recursive:
+                        yield from self._scan(entry.path)
+                elif entry.is_file() and entry.name.endswith(".fits"):
+                    yield entry.path, entry.stat()
+            except OSError:
+                # Files can vanish while we are looking at them.
+                continue
+        
+    def poll(self, now=None):
+        """Poll the watched directories, returning the files which are ready to import."""
+        now = time.monotonic() if now is None else now
+        ready = []
+        for directory in sorted(self._directories):
+            for filename, stat in self._scan(directory):
+                signature = (stat.st_size, stat.st_mtime, stat.st_ino)
+                if self._manifest.get(filename, None) == signature or self._failed.get(filename, None) == signature:
+                    continue
+                seen, since = self._pending.get(filename, (None, None))
+                if seen != signature:
+                    self._pending[filename] = (signature, now)
+                elif now - since >= self.settle and stat.st_size and stat.st_size % BLOCKSIZE == 0:
+                    ready.append(filename)
+        return ready
+    
+    def done(self, filenames):
+        """Mark files as imported."""
+        for filename in filenames:
+            signature, since = self._pending.pop(filename)
+            self._manifest[filename] = signature
+    
+    def failed(self, filenames):
+        """Mark files which failed to import, so that they are only tried again once they change."""
+        for filename in filenames:
+            signature, since = self._pending.pop(filename)
+            self._failed[filename] = signature
+    
+
+@app.cli.command()
+@click.option('--interval', type=float, default=0.5, help="Seconds between polls of the data directories.")
+@click.option('--settle', type=float, default=1.0, help="Seconds a file must be unchanged before it is imported.")
+@click.option('--days', type=int, default=1, help="Watch the logs from this many days ago.")
+@click.option('--refresh', type=float, default=60.0, help="Seconds between checks for new observing logs.")
+@click.option('--retry', type=float, default=10.0, help="Seconds to wait after the database fails before trying again.")
+@click.option('--recursive', '-r', is_flag=True, help="Watch data directories recursively.")
+def owatch(interval, settle, days, refresh, retry, recursive):
+    """Watch the data directories of active OSIRIS logs and import new files."""
+    watcher = DirectoryWatcher(settle=settle, recursive=recursive)
+    last_refresh = None
+    while True:
+        try:
+            if last_refresh is None or time.monotonic() - last_refresh > refresh:
+                for directory in active_directories(days=days):
+                    if watcher.watch(directory, db.session):
+                        click.echo("Watching '{0:s}'".format(directory))
+                db.session.commit()
+                last_refresh = time.monotonic()
+            
+            ready = watcher.poll()
+            if ready:
+                errors = import_osiris_files(ready, db.session)
+                # Files which failed are in the journal, and are tried again when they change.
+                watcher.failed(filename for filename in ready if filename in errors)
+                watcher.done(filename for filename in ready if filename not in errors)
+        except Exception as e:
+            # Files which weren't imported are still pending, and are tried again.
+            db.session.rollback()
+            click.echo("Error: {0!r}, retrying in {1:.0f}s".format(e, retry), err=True)
+            time.sleep(retry)
+            continue
+        time.sleep(interval)
+    
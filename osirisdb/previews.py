@@ -4,7 +4,14 @@ Generate previews
 """
 
 import collections
+import functools
+import itertools
+import struct
+import warnings
+import zlib
 import attr
+import h5py
+import numpy as np
 import matplotlib
 matplotlib.use("Agg")
 import matplotlib.pyplot as plt
@@ -34,20 +41,381 @@ class _Preview(collections.Mapping):
     
 Preview = _Preview()
 
+#: Version of the preview renderers, part of the cache key so that changes invalidate cached previews.
+PREVIEW_VERSION = 2
+
+def write_preview(datafile, path):
+    """Render the preview of a file and write it to path as a PNG."""
+    figure = Preview[datafile.kind](datafile)
+    try:
+        figure.savefig(path, format='png')
+    finally:
+        plt.close(figure)
+
+def encode_png(image, level=6):
+    """Encode an 8-bit grayscale (N, M), RGB (N, M, 3) or RGBA (N, M, 4) image as PNG."""
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    height, width = image.shape[:2]
+    channels = 1 if image.ndim == 2 else image.shape[2]
+    color_type = {1:0, 3:2, 4:6}[channels]
+    
+    # Each scanline starts with a filter type byte, and we use no filtering.
+    raw = np.zeros((height, 1 + width * channels), dtype=np.uint8)
+    raw[:,1:] = image.reshape(height, width * channels)
+    
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+    
+    return b"".join([
+        b"\x89PNG\r\n\x1a\n",
+        chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)),
+        chunk(b"IDAT", zlib.compress(raw.tobytes(), level)),
+        chunk(b"IEND", b""),
+    ])
+
+def placeholder():
+    """A light gray placeholder image, shown while a preview is rendered."""
+    return encode_png(np.full((8, 8), 230, dtype=np.uint8))
+
 @Preview.register('fits')
 def preview_fits(datafile):
     """Generate a preview for a FITS file"""
     with datafile.open() as HDUs:
         primary_hdu = HDUs[0]
+        if primary_hdu.data.ndim == 3:
+            return preview_cube(primary_hdu, datafile.collapsed())
         dispatch_methods = {
             1:preview_spectrum, 
             2:preview_image,
-            3:preview_cube,
         }
         figure = dispatch_methods[primary_hdu.data.ndim](primary_hdu)
     return figure
 
 
+Thumbnail = _Preview()
+
+#: Sizes (in pixels, along the longest side) at which thumbnails are rendered.
+THUMBNAIL_SIZES = (64, 128, 256)
+
+def write_thumbnail(datafile, size, path):
+    """Render a thumbnail of a file and write it to path as a PNG."""
+    image = Thumbnail[datafile.kind](datafile, size)
+    with open(path, 'wb') as f:
+        f.write(encode_png(image))
+
+@functools.lru_cache()
+def colormap_lut(name='Blues_r'):
+    """A (256, 3) lookup table of 8-bit RGB values for a matplotlib colormap."""
+    cmap = plt.get_cmap(name)
+    return (cmap(np.linspace(0.0, 1.0, 256))[:,:3] * 255).round().astype(np.uint8)
+
+def _fit_shape(shape, size):
+    """The shape with the longest side scaled to size, preserving the aspect ratio."""
+    scale = size / max(shape)
+    return tuple(max(1, int(round(n * scale))) for n in shape)
+
+def resample(image, shape):
+    """Resample an image to shape, averaging blocks of pixels when shrinking, then taking the nearest pixel."""
+    factors = [max(1, n // m) for n, m in zip(image.shape, shape)]
+    if any(factor > 1 for factor in factors):
+        (ny, nx), (fy, fx) = image.shape, factors
+        blocks = image[:ny - ny % fy,:nx - nx % fx].reshape(ny // fy, fy, nx // fx, fx)
+        with np.errstate(invalid='ignore'):
+            image = np.nanmean(blocks, axis=(1, 3))
+    rows = ((np.arange(shape[0]) + 0.5) * image.shape[0] / shape[0]).astype(int)
+    columns = ((np.arange(shape[1]) + 0.5) * image.shape[1] / shape[1]).astype(int)
+    return image[rows[:,None], columns[None,:]]
+
+def interval(image, percentile=90.0):
+    """The (lower, upper) limits of the central ``percentile`` of finite values in an image."""
+    image = np.asarray(image, dtype=np.float64)
+    finite = image[np.isfinite(image)]
+    if not finite.size:
+        return 0.0, 1.0
+    lower, upper = np.percentile(finite, [50.0 - percentile / 2.0, 50.0 + percentile / 2.0])
+    return lower, upper
+
+def normalize(image, percentile=90.0, a=1000.0, limits=None):
+    """Scale an image to [0, 1], with the equivalent of astropy's PercentileInterval and LogStretch.
+    
+    The interval can be given as ``limits``, so that parts of one image are scaled alike.
+    """
+    image = np.asarray(image, dtype=np.float64)
+    lower, upper = interval(image, percentile) if limits is None else limits
+    scaled = (image - lower) / ((upper - lower) or 1.0)
+    scaled = np.clip(np.nan_to_num(scaled), 0.0, 1.0)
+    return np.log(a * scaled + 1.0) / np.log(a + 1.0)
+
+def colorize(image, size, cmap='Blues_r'):
+    """Render an image as an 8-bit RGB thumbnail, with the origin at the lower left."""
+    image = resample(image, _fit_shape(image.shape, size))
+    index = (normalize(image) * 255).round().astype(np.uint8)
+    return colormap_lut(cmap)[index[::-1]]
+
+def plot_spectrum(spectrum, size, color=(8, 48, 107)):
+    """Render a spectrum as an 8-bit RGB line plot thumbnail, drawing the range of values in each pixel column."""
+    spectrum = np.asarray(spectrum, dtype=np.float64)
+    width, height = size, max(1, size // 2)
+    image = np.full((height, width, 3), 255, dtype=np.uint8)
+    if not np.isfinite(spectrum).any():
+        return image
+    starts = np.linspace(0, spectrum.size, width, endpoint=False).astype(int)
+    low = np.fmin.reduceat(spectrum, starts)
+    high = np.fmax.reduceat(spectrum, starts)
+    vmin, vmax = np.nanmin(low), np.nanmax(high)
+    scale = (height - 1) / ((vmax - vmin) or 1.0)
+    top = np.nan_to_num((vmax - high) * scale, nan=height).astype(int)
+    bottom = np.nan_to_num((vmax - low) * scale, nan=-1).astype(int)
+    rows = np.arange(height)[:,None]
+    image[(rows >= top[None,:]) & (rows <= bottom[None,:])] = color
+    return image
+
+def _wave_axis(header, ndim):
+    """The numpy axis of the wavelength axis, from the CTYPEn keywords, or the first axis."""
+    for n in range(1, ndim + 1):
+        if str(header.get("CTYPE{0:d}".format(n), "")).startswith("WAVE"):
+            return ndim - n
+    return 0
+
+#: Methods for collapsing a cube along wavelength.
+COLLAPSE_METHODS = ('median', 'approximate', 'mean')
+
+#: Number of wavelength channels sampled by the approximate collapse.
+APPROXIMATE_CHANNELS = 256
+
+def collapse(data, axis, method='median', chunk_bytes=64 * 1024 * 1024):
+    """Collapse a cube along an axis, reading at most ``chunk_bytes`` of it at a time.
+    
+    The cube is read in chunks along a spatial axis, so memory-mapped data is
+    never loaded at once. ``median`` is exact, ``approximate`` takes the median of
+    a subset of channels, and ``mean`` ignores NaN values.
+    """
+    if method not in COLLAPSE_METHODS:
+        raise ValueError("Unknown collapse method {0!r}".format(method))
+    chunk_axis = [n for n in range(data.ndim) if n != axis][0]
+    channels = slice(None)
+    if method == 'approximate':
+        channels = slice(None, None, max(1, data.shape[axis] // APPROXIMATE_CHANNELS))
+    reduce = np.nanmean if method == 'mean' else np.nanmedian
+    
+    row_bytes = 8 * (data.size // data.shape[chunk_axis])
+    step = max(1, chunk_bytes // max(1, row_bytes))
+    pieces = []
+    for start in range(0, data.shape[chunk_axis], step):
+        index = [slice(None)] * data.ndim
+        index[chunk_axis] = slice(start, start + step)
+        index[axis] = channels
+        chunk = np.asarray(data[tuple(index)], dtype=np.float64)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            pieces.append(reduce(chunk, axis=axis))
+    return np.concatenate(pieces, axis=0)
+
+def write_collapsed(datafile, path, method='median', chunk_bytes=64 * 1024 * 1024, channels=None):
+    """Collapse the cube in a file along wavelength, and write the image to path as ``.npy``.
+    
+    ``channels`` is a (start, stop) range of wavelength channels to collapse, which
+    are the only channels read from the file.
+    """
+    with datafile.open() as HDUs:
+        primary_hdu = HDUs[0]
+        data = primary_hdu.data
+        if data is None or data.ndim != 3:
+            raise ValueError("'{0:s}' does not contain a cube".format(datafile.filename))
+        wave_axis = _wave_axis(primary_hdu.header, data.ndim)
+        if channels is not None:
+            start, stop = channels
+            if not (0 <= start < stop <= data.shape[wave_axis]):
+                raise IndexError("Channels {0:d}:{1:d} are outside the cube".format(start, stop))
+            index = [slice(None)] * data.ndim
+            index[wave_axis] = slice(start, stop)
+            data = data[tuple(index)]
+        image = collapse(data, wave_axis, method=method, chunk_bytes=chunk_bytes)
+    with open(path, 'wb') as f:
+        np.save(f, image)
+
+#: Size of a tile in the image pyramid, in pixels.
+TILE_SIZE = 256
+
+def tile_levels(shape, tile_size=TILE_SIZE):
+    """The number of zoom levels in the image pyramid. The last level is at the full resolution."""
+    return int(np.ceil(np.log2(max(1.0, max(shape) / tile_size)))) + 1
+
+def write_tile(image, z, x, y, path, tile_size=TILE_SIZE, cmap='Blues_r'):
+    """Render one tile of the image pyramid and write it to path as a PNG.
+    
+    Tile (0, 0) is at the upper left, with the image origin at the lower left. Tiles are
+    scaled to the interval of the whole image, and pixels beyond its edge are transparent.
+    """
+    levels = tile_levels(image.shape, tile_size)
+    if not 0 <= z < levels:
+        raise IndexError("Zoom level {0:d} is outside the pyramid".format(z))
+    factor = 2 ** (levels - 1 - z)
+    span = tile_size * factor
+    flipped = image[::-1]
+    region = np.asarray(flipped[y * span:(y + 1) * span, x * span:(x + 1) * span], dtype=np.float64)
+    if x < 0 or y < 0 or not region.size:
+        raise IndexError("Tile {0:d}/{1:d}/{2:d} is outside the image".format(z, x, y))
+    
+    # Pad to whole blocks, so that edge pixels are averaged over their valid part.
+    padded = np.full((-(-region.shape[0] // factor) * factor, -(-region.shape[1] // factor) * factor), np.nan)
+    padded[:region.shape[0],:region.shape[1]] = region
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        blocks = np.nanmean(padded.reshape(padded.shape[0] // factor, factor, padded.shape[1] // factor, factor), axis=(1, 3))
+    
+    tile = np.zeros((tile_size, tile_size, 4), dtype=np.uint8)
+    index = (normalize(blocks, limits=interval(image)) * 255).round().astype(np.uint8)
+    tile[:blocks.shape[0],:blocks.shape[1],:3] = colormap_lut(cmap)[index]
+    tile[:blocks.shape[0],:blocks.shape[1],3] = 255
+    with open(path, 'wb') as f:
+        f.write(encode_png(tile))
+
+def write_image(image, size, path):
+    """Render an image as a thumbnail-style PNG and write it to path."""
+    with open(path, 'wb') as f:
+        f.write(encode_png(colorize(image, size)))
+
+@Thumbnail.register('fits')
+def thumbnail_fits(datafile, size):
+    """Generate a thumbnail for a FITS file, without matplotlib"""
+    with datafile.open() as HDUs:
+        primary_hdu = HDUs[0]
+        data = primary_hdu.data
+        if data.ndim == 1:
+            return plot_spectrum(data, size)
+        if data.ndim == 3:
+            data = datafile.collapsed()
+        return colorize(data, size)
+
+#: Number of samples read along each axis of an HDF5 dataset, by number of dimensions.
+HDF5_PREVIEW_SAMPLES = {1: 16384, 2: 512, 3: 256}
+
+#: Number of wavelength channels sampled from an HDF5 cube.
+HDF5_PREVIEW_CHANNELS = 32
+
+#: Maximum number of chunks read from a chunked HDF5 dataset.
+HDF5_PREVIEW_CHUNKS = 64
+
+#: Maximum number of bytes read from a chunked HDF5 dataset, which limits the number of large chunks read.
+HDF5_PREVIEW_BYTES = 64 * 1024 * 1024
+
+def _hdf5_datasets(group):
+    """Find the numeric 1D, 2D and 3D datasets in an HDF5 group."""
+    datasets = []
+    def visit(name, obj):
+        if isinstance(obj, h5py.Dataset) and 1 <= obj.ndim <= 3 and obj.dtype.kind in 'iuf':
+            datasets.append(obj)
+    group.visititems(visit)
+    return datasets
+
+def _chunk_grid(shape, chunks, counts, max_chunks=HDF5_PREVIEW_CHUNKS):
+    """Choose evenly spaced chunk indices along each axis, touching at most ``max_chunks`` chunks.
+    
+    ``counts`` is the number of chunks wanted along each axis. Axes with the most
+    chunks are halved until the whole grid fits.
+    """
+    totals = [-(-length // chunk) for length, chunk in zip(shape, chunks)]
+    counts = [max(1, min(count, total)) for count, total in zip(counts, totals)]
+    while np.prod(counts) > max_chunks and max(counts) > 1:
+        axis = int(np.argmax(counts))
+        counts[axis] = -(-counts[axis] // 2)
+    return [np.unique(np.linspace(0, total - 1, count).round().astype(int))
+            for total, count in zip(totals, counts)]
+
+def _block_reduce(data, factors):
+    """Average blocks of ``factors`` elements along each axis, ignoring NaNs and padding edges with NaN."""
+    padding = [(0, -length % factor) for length, factor in zip(data.shape, factors)]
+    if any(after for before, after in padding):
+        data = np.pad(data, padding, mode='constant', constant_values=np.nan)
+    shape = []
+    for length, factor in zip(data.shape, factors):
+        shape.extend([length // factor, factor])
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        return np.nanmean(data.reshape(shape), axis=tuple(range(1, 2 * data.ndim, 2)))
+
+def _read_chunked(dataset, samples, wave_axis=None):
+    """Read a mosaic of whole chunks, on a grid of at most ``HDF5_PREVIEW_CHUNKS`` chunks and ``HDF5_PREVIEW_BYTES``.
+    
+    Each chunk is read whole, so no other chunks are touched, and block-averaged
+    so that about ``samples`` elements are kept along each axis. Channels along
+    ``wave_axis`` are kept as read.
+    """
+    chunks = dataset.chunks
+    counts = [HDF5_PREVIEW_CHUNKS] * dataset.ndim
+    if wave_axis is not None:
+        counts[wave_axis] = -(-HDF5_PREVIEW_CHANNELS // chunks[wave_axis])
+    chunk_bytes = int(np.prod(chunks)) * dataset.dtype.itemsize
+    grid = _chunk_grid(dataset.shape, chunks, counts, min(HDF5_PREVIEW_CHUNKS, max(1, HDF5_PREVIEW_BYTES // chunk_bytes)))
+    
+    extents, factors = [], []
+    for axis, (length, chunk, indices) in enumerate(zip(dataset.shape, chunks, grid)):
+        extent = [(i * chunk, min((i + 1) * chunk, length)) for i in indices]
+        factor = 1 if axis == wave_axis else max(1, -(-sum(stop - start for start, stop in extent) // samples[axis]))
+        extents.append(extent)
+        factors.append(factor)
+    
+    offsets = [np.cumsum([0] + [-(-(stop - start) // factor) for start, stop in extent])
+               for extent, factor in zip(extents, factors)]
+    data = np.full([offset[-1] for offset in offsets], np.nan)
+    for position in itertools.product(*[range(len(extent)) for extent in extents]):
+        block = dataset[tuple(slice(*extents[axis][n]) for axis, n in enumerate(position))]
+        block = _block_reduce(np.asarray(block, dtype=np.float64), factors)
+        data[tuple(slice(offsets[axis][n], offsets[axis][n + 1]) for axis, n in enumerate(position))] = block
+    return data
+
+def read_hdf5(datafile):
+    """Read a subsampled copy of the largest 1D, 2D or 3D dataset in an HDF5 file.
+    
+    Chunked datasets are sampled in whole chunks, so only a bounded number of chunks
+    is read. Contiguous datasets are read with a stride. Cubes are collapsed along
+    wavelength, which is the axis named by the dataset's ``wave_axis`` attribute, or
+    else its longest axis, with the median of sampled channels.
+    """
+    with datafile.open() as f:
+        datasets = _hdf5_datasets(f)
+        if not datasets:
+            raise ValueError("No 1D, 2D or 3D datasets in '{0:s}'".format(datafile.filename))
+        dataset = max(datasets, key=lambda dataset: dataset.size)
+        wave_axis = None
+        samples = [HDF5_PREVIEW_SAMPLES[dataset.ndim]] * dataset.ndim
+        if dataset.ndim == 3:
+            wave_axis = int(dataset.attrs.get('wave_axis', np.argmax(dataset.shape)))
+            samples[wave_axis] = HDF5_PREVIEW_CHANNELS
+        if dataset.chunks is not None:
+            data = _read_chunked(dataset, samples, wave_axis)
+        else:
+            index = tuple(slice(None, None, max(1, length // n)) for length, n in zip(dataset.shape, samples))
+            data = np.asarray(dataset[index], dtype=np.float64)
+    if wave_axis is not None:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            data = np.nanmedian(data, axis=wave_axis)
+    return data
+
+@Preview.register('hdf5')
+def preview_hdf5(datafile):
+    """Generate a preview for an HDF5 file"""
+    data = read_hdf5(datafile)
+    fig, ax = plt.subplots(1,1)
+    if data.ndim == 1:
+        ax.plot(data)
+        ax.set_ylabel("Flux")
+    else:
+        im = ax.imshow(normalize(data), origin='lower', cmap='Blues_r')
+        fig.colorbar(im, ax=ax)
+    return fig
+
+@Thumbnail.register('hdf5')
+def thumbnail_hdf5(datafile, size):
+    """Generate a thumbnail for an HDF5 file, without matplotlib"""
+    data = read_hdf5(datafile)
+    if data.ndim == 1:
+        return plot_spectrum(data, size)
+    return colorize(data, size)
+
+
 def wavelength(HDU):
     """Get wavelength from an HDU with WCS."""
     import astropy.units as u
@@ -61,7 +429,7 @@ def wavelength(HDU):
     pix = np.zeros((shape[wave_axis], len(wcs.axis_type_names)))
     
     pix[:,0] = np.arange(shape[wave_axis])
-    world = wcs.all_pix2world(pix, 1)
+    world = wcs.all_pix2world(pix, 0)
     wl = world[:,0] * u.Unit(u.m)
     return wl.to(u.Unit(HDU.header.get("CUNIT{0}".format(wcs.axis_type_names.index('WAVE')),u.m)))
 
@@ -91,8 +459,8 @@ def preview_image(HDU):
         fig.colorbar(im, ax=ax)
     return fig
     
-def preview_cube(HDU):
-    """Preview a datacube"""
+def preview_cube(HDU, image=None):
+    """Preview a datacube, or the image collapsed from it"""
     from astropy.visualization import quantity_support, PercentileInterval, LogStretch
     from astropy.visualization.mpl_normalize import ImageNormalize
     from astropy.wcs import WCS
@@ -101,7 +469,8 @@ def preview_cube(HDU):
     wcs = WCS(HDU.header)
     wave_axis = HDU.data.ndim - wcs.axis_type_names.index('WAVE') - 1
     wcs = wcs.dropaxis(wcs.axis_type_names.index('WAVE'))
-    image = np.median(HDU.data, axis=wave_axis)
+    if image is None:
+        image = collapse(HDU.data, wave_axis)
     
     with quantity_support():
         fig = plt.figure()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Render previews in a pool of worker processes.
+"""
+
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import attr
+from flask import current_app
+
+__all__ = ['RenderQueue', 'render_queue', 'render_preview', 'render_thumbnail',
+           'render_collapsed', 'render_channel_image', 'render_tile', 'preview_job']
+
+def preview_job(datafile):
+    """The attributes of a data file needed to render its previews in a worker process."""
+    return dict(id=datafile.id, kind=datafile.kind, host=datafile.host, filename=datafile.filename,
+                size=datafile.size, mtime=datafile.mtime, checksum=datafile.checksum)
+
+def render_preview(attrs, sizes=()):
+    """Render the preview of a file, and thumbnails at ``sizes``, into the cache. This runs in a worker process."""
+    from .application import app
+    from .model import DataFile
+    
+    with app.app_context():
+        datafile = DataFile(**attrs)
+        for size in sizes:
+            datafile.thumbnail(size)
+        return datafile.preview()
+
+def render_thumbnail(attrs, size):
+    """Render a thumbnail of a file into the cache. This runs in a worker process."""
+    from .application import app
+    from .model import DataFile
+    
+    with app.app_context():
+        return DataFile(**attrs).thumbnail(size)
+
+def render_collapsed(attrs, method=None, channels=None):
+    """Collapse the cube in a file, or a range of its channels, into the cache. This runs in a worker process."""
+    from .application import app
+    from .model import DataFile
+    
+    with app.app_context():
+        # Only the shape is returned, as the collapsed cube is memory-mapped from the cache.
+        return DataFile(**attrs).collapsed(method, channels).shape
+
+def render_channel_image(attrs, channels, size, method=None):
+    """Render an image of a range of channels of the cube in a file into the cache. This runs in a worker process."""
+    from .application import app
+    from .model import DataFile
+    
+    with app.app_context():
+        return DataFile(**attrs).channel_image(channels, size, method)
+
+def render_tile(attrs, z, x, y, channels=None, method=None):
+    """Render a tile of the image pyramid of the cube in a file into the cache. This runs in a worker process."""
+    from .application import app
+    from .model import DataFile
+    
+    with app.app_context():
+        return DataFile(**attrs).tile(z, x, y, channels, method)
+
+@attr.s
+class RenderQueue(object):
+    """A queue of render jobs, run by a pool of worker processes.
+    
+    Jobs are deduplicated by an identifier, so a job which is already
+    queued or running is never submitted again.
+    """
+    
+    processes = attr.ib(default=None)
+    _executor = attr.ib(default=None, init=False)
+    _jobs = attr.ib(default=attr.Factory(dict), init=False)
+    _errors = attr.ib(default=attr.Factory(dict), init=False)
+    _lock = attr.ib(default=attr.Factory(threading.Lock), init=False)
+    
+    @property
+    def executor(self):
+        """The pool of worker processes, started on first use."""
+        if self._executor is None:
+            processes = self.processes or current_app.config.get('PREVIEW_RENDER_PROCESSES', 2)
+            # Forking a threaded web server is unsafe, so workers are started fresh.
+            self._executor = ProcessPoolExecutor(max_workers=processes,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+    
+    def submit(self, identifier, function, *args):
+        """Submit a job, unless a job with this identifier is already queued or running."""
+        with self._lock:
+            future = self._jobs.get(identifier, None)
+            if future is not None:
+                return future
+            self._errors.pop(identifier, None)
+            executor = self.executor
+            try:
+                future = executor.submit(function, *args)
+            except BrokenProcessPool:
+                # A worker died, e.g. out of memory, so start a fresh pool.
+                self._discard(executor)
+                executor = self.executor
+                future = executor.submit(function, *args)
+            self._jobs[identifier] = future
+        # A job which has already finished runs the callback at once, so the lock must be released.
+        future.add_done_callback(lambda future: self._done(identifier, future, executor))
+        return future
+    
+    def _discard(self, executor):
+        """Stop using a broken pool of workers. Call with the lock held."""
+        if self._executor is executor:
+            self._executor = None
+            executor.shutdown(wait=False)
+    
+    def _done(self, identifier, future, executor):
+        """Remove a finished job, remembering its error."""
+        with self._lock:
+            if self._jobs.get(identifier, None) is future:
+                del self._jobs[identifier]
+            if not future.cancelled() and future.exception() is not None:
+                self._errors[identifier] = future.exception()
+                if isinstance(future.exception(), BrokenProcessPool):
+                    # Jobs which were pending in the broken pool fail, and later jobs go to a new pool.
+                    self._discard(executor)
+    
+    def pending(self, identifier):
+        """Whether a job is queued or running."""
+        return identifier in self._jobs
+    
+    def error(self, identifier):
+        """Pop the error raised by the last job with this identifier, if it failed."""
+        with self._lock:
+            return self._errors.pop(identifier, None)
+    
+render_queue = RenderQueue()
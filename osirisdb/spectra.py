@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Extract spectra from data cubes.
+"""
+
+import os
+import functools
+
+import numpy as np
+from astropy.io import fits
+
+from .previews import wavelength, _wave_axis
+
+__all__ = ['wavelength_axis', 'spatial_shape', 'extract_spectrum', 'write_spectrum', 'spectrum_dtype', 'spectrum_unit']
+
+def spectrum_dtype(unit):
+    """The record type of a spectrum, with the wavelength unit as the title of the wavelength field."""
+    return np.dtype([((unit, 'wavelength'), '<f8'), ('flux', '<f8')])
+
+def spectrum_unit(spectrum):
+    """The wavelength unit of a spectrum, from the title of its wavelength field."""
+    return spectrum.dtype.fields['wavelength'][2]
+
+@functools.lru_cache(maxsize=256)
+def _wavelength_axis(filename, size, mtime):
+    """The wavelength axis of a cube, memoized on the file's identity."""
+    with fits.open(filename) as HDUs:
+        wl = wavelength(HDUs[0])
+    return wl.value, wl.unit.to_string()
+
+def wavelength_axis(filename):
+    """The (values, unit) of the wavelength axis of the cube in a FITS file, computed once per version of the file."""
+    stat = os.stat(filename)
+    return _wavelength_axis(filename, stat.st_size, stat.st_mtime_ns)
+
+@functools.lru_cache(maxsize=256)
+def _spatial_shape(filename, size, mtime):
+    """The spatial shape of a cube, memoized on the file's identity."""
+    header = fits.getheader(filename)
+    ndim = header.get('NAXIS', 0)
+    if ndim != 3:
+        raise ValueError("'{0:s}' does not contain a cube".format(filename))
+    shape = [header["NAXIS{0:d}".format(n)] for n in range(ndim, 0, -1)]
+    wave_axis = _wave_axis(header, ndim)
+    return tuple(n for axis, n in enumerate(shape) if axis != wave_axis)
+
+def spatial_shape(filename):
+    """The (ny, nx) spatial shape of the cube in a FITS file, read from its header once per version of the file."""
+    stat = os.stat(filename)
+    return _spatial_shape(filename, stat.st_size, stat.st_mtime_ns)
+
+def extract_spectrum(data, wave_axis, x, y, r=0.0):
+    """Sum the spectra of the spaxels within ``r`` pixels of (x, y).
+
+    x and y index the spatial axes of the cube in the order of its collapsed
+    image, i.e. y is the first spatial axis. Only the box around the aperture
+    is read, so memory-mapped cubes are read for just those spaxels. Apertures
+    larger than the cube are clamped to its diagonal, which covers all of it.
+    """
+    spatial = [n for n in range(data.ndim) if n != wave_axis]
+    ny, nx = (data.shape[n] for n in spatial)
+    if not (0 <= x < nx and 0 <= y < ny):
+        raise IndexError("Spaxel ({0:d}, {1:d}) is outside the cube".format(x, y))
+    if not 0 <= r < np.inf:
+        raise ValueError("Aperture radius {0!r} is not a finite, non-negative number".format(r))
+    r = min(r, np.hypot(nx, ny))
+    extent = int(np.floor(r))
+    y0, y1 = max(0, y - extent), min(ny, y + extent + 1)
+    x0, x1 = max(0, x - extent), min(nx, x + extent + 1)
+    index = [slice(None)] * data.ndim
+    index[spatial[0]], index[spatial[1]] = slice(y0, y1), slice(x0, x1)
+    box = np.moveaxis(np.asarray(data[tuple(index)], dtype=np.float64), wave_axis, -1)
+
+    yy, xx = np.mgrid[y0:y1,x0:x1]
+    aperture = (yy - y) ** 2 + (xx - x) ** 2 <= r ** 2
+    return np.nansum(box[aperture], axis=0)
+
+def write_spectrum(datafile, x, y, r, path):
+    """Extract a spectrum from the cube in a file, and write it to path as a ``.npy`` record array.
+
+    The wavelength unit is kept in the file, as the title of the wavelength field.
+    """
+    values, unit = wavelength_axis(datafile.local_path())
+    with datafile.open() as HDUs:
+        primary_hdu = HDUs[0]
+        data = primary_hdu.data
+        if data is None or data.ndim != 3:
+            raise ValueError("'{0:s}' does not contain a cube".format(datafile.filename))
+        flux = extract_spectrum(data, _wave_axis(primary_hdu.header, data.ndim), x, y, r)
+    spectrum = np.empty(flux.shape, dtype=spectrum_dtype(unit))
+    spectrum['wavelength'] = values
+    spectrum['flux'] = flux
+    with open(path, 'wb') as f:
+        np.save(f, spectrum)
@@ -13,3 +13,24 @@ $(document).ready(function(){
     });
     
 });
+
+$(document).ready(function(){
+    // Previews are rendered in the background, and return 202 until they are ready.
+    var poll_preview = function(image){
+        var source = image.attr('src').split('?')[0]
+        $.ajax({type: 'HEAD', url: source}).done(function(data, status, xhr){
+            if (xhr.status == 202) {
+                var delay = parseFloat(xhr.getResponseHeader('Retry-After') || '2')
+                setTimeout(function(){ poll_preview(image) }, delay * 1000)
+            } else {
+                image.attr('src', source + '?ready=' + String(Date.now()))
+            }
+        })
+    }
+    $('img.preview-image').each(function(){ poll_preview($(this)) })
+    // Thumbnails load lazily, so only those which arrive as the 8x8 placeholder are polled.
+    var poll_placeholder = function(){
+        if (this.complete && this.naturalWidth == 8 && this.naturalHeight == 8) { poll_preview($(this)) }
+    }
+    $('img.thumbnail').on('load', poll_placeholder).each(poll_placeholder)
+});
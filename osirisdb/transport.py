@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""
+Access data files held by other hosts, through shared mounts or by fetching them into a local cache.
+"""
+
+import os
+import socket
+import subprocess
+import contextlib
+
+from flask import current_app
+
+from .cache import FileCache
+
+__all__ = ['Transport', 'TransportError', 'local_path', 'pinned_path', 'is_local', 'mounted_path', 'fetch_cache']
+
+class TransportError(IOError):
+    """A file could not be fetched from another host."""
+    pass
+
+class _Transports(dict):
+    """A collection of functions which copy ``filename`` from ``host`` to a local ``path``."""
+
+    def register(self, name):
+        """Register a transport by name."""
+        def _decorator(f):
+            self[name] = f
+            return f
+        return _decorator
+
+Transport = _Transports()
+
+def _run(command):
+    """Run a transport command, raising TransportError if it fails."""
+    try:
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+        raise TransportError("{0:s} failed: {1:s}".format(command[0], e.stderr.decode('utf-8', 'replace').strip()))
+
+@Transport.register('rsync')
+def fetch_rsync(host, filename, path):
+    """Fetch a file with rsync over SSH, preserving its modification time."""
+    _run([current_app.config.get('DATAFILE_RSYNC', 'rsync'), '--times', '{0:s}:{1:s}'.format(host, filename), path])
+
+@Transport.register('scp')
+def fetch_scp(host, filename, path):
+    """Fetch a file with scp, preserving its modification time."""
+    _run([current_app.config.get('DATAFILE_SCP', 'scp'), '-p', '-q', '{0:s}:{1:s}'.format(host, filename), path])
+
+def is_local(host):
+    """Whether files on host are on this machine."""
+    return host is None or host == socket.gethostname() or host in current_app.config.get('DATAFILE_LOCAL_HOSTS', ())
+
+def mounted_path(host, filename):
+    """The path to a file on host through a shared mount, from ``DATAFILE_MOUNTS``, or None."""
+    for remote, local in current_app.config.get('DATAFILE_MOUNTS', {}).get(host, {}).items():
+        remote = os.path.join(remote, "")
+        if filename.startswith(remote):
+            return os.path.join(local, filename[len(remote):])
+    return None
+
+def fetch_cache():
+    """The cache of files fetched from other hosts."""
+    return FileCache(current_app.config.get('DATAFILE_FETCH_CACHE', 'fetched/'),
+                     current_app.config.get('DATAFILE_FETCH_CACHE_SIZE', None))
+
+def _fetch(host, filename, version):
+    """The fetch cache key, writer and suffix for a file on another host."""
+    name = current_app.config.get('DATAFILE_TRANSPORTS', {}).get(host, current_app.config.get('DATAFILE_TRANSPORT', 'rsync'))
+    transport = Transport[name]
+    key = FileCache.key(host, filename, version)
+    # Keep the extension, which astropy uses to recognize the file.
+    suffix = os.path.splitext(filename)[1]
+    return key, lambda path: transport(host, filename, path), suffix
+
+def local_path(host, filename, version):
+    """A local path to filename on host.
+
+    Files which are not local or on a shared mount are fetched into the fetch cache, keyed
+    on their ``version`` so that rewritten files are fetched again. A file is fetched once,
+    even when several processes ask for it at the same time.
+    """
+    if is_local(host):
+        return filename
+    path = mounted_path(host, filename)
+    if path is not None:
+        return path
+    return fetch_cache().get_or_put(*_fetch(host, filename, version))
+
+@contextlib.contextmanager
+def pinned_path(host, filename, version):
+    """Like :func:`local_path`, but a fetched file is kept in the fetch cache until the context exits."""
+    path = filename if is_local(host) else mounted_path(host, filename)
+    if path is not None:
+        yield path
+        return
+    with fetch_cache().pinned(*_fetch(host, filename, version)) as path:
+        yield path
@@ -7,12 +7,24 @@ import datetime
 from os.path import join as pjoin
 
 
+def archive_dates(year, month=None, day=None):
+    """The [start, end) dates of a year, a month or a day."""
+    start = datetime.date(year, month or 1, day or 1)
+    if month is None:
+        end = datetime.date(year + 1, 1, 1)
+    elif day is None:
+        end = datetime.date(year + month // 12, month % 12 + 1, 1)
+    else:
+        end = start + datetime.timedelta(days=1)
+    return start, end
+
 class ArchiveView(View):
     """A view of an archive."""
     
-    def __init__(self, model, template, datefield='date', modelcontextname=None, perpage=100):
+    def __init__(self, model, template, datefield='date', modelcontextname=None, perpage=100, prefetch=None):
         super(ArchiveView, self).__init__()
         self.model = model
+        self.prefetch = prefetch
         self.template = template
         self._datefield = datefield
         self.modelcontextname = modelcontextname or (self.model.__name__.lower() + "s")
@@ -20,16 +32,12 @@ class ArchiveView(View):
     
     def dispatch_request(self, year=None, month=None, day=None, page=None):
         """Archive request dispatcher."""
-        start = datetime.date(year, month or 1, day or 1)
-        if month is None:
-            end = datetime.date(year + 1, 1, 1)
-        elif day is None:
-            _year = year + (month // 12)
-            _month = ((month + 1) % 12) + 1
-            end = datetime.date(_year, _month, 1)
-        else:
-            end = start + datetime.timedelta(days=1)
-        objects = self.model.query.filter(getattr(self.model,self._datefield).between(start, end)).paginate(page, per_page=self.perpage)
+        start, end = archive_dates(year, month, day)
+        column = getattr(self.model, self._datefield)
+        objects = self.model.query.filter(column >= start, column < end).paginate(page, per_page=self.perpage)
+        if self.prefetch is not None:
+            # Load whatever the page shows for its objects with a fixed number of queries.
+            self.prefetch(objects.items)
         context = {self.modelcontextname:objects, 'year':year, 'month':month, 'day':day}
         return render_template(pjoin(self.template, 'archive.html'), **context)
     
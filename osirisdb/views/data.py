@@ -3,11 +3,21 @@
 Views for servering data files.
 """
 
-from flask import render_template, redirect, request, g, send_from_directory, send_file
+from flask import render_template, redirect, request, g, send_from_directory, send_file, make_response, abort, jsonify
 from flask.views import MethodView
+from werkzeug.datastructures import Headers
+from werkzeug.wsgi import wrap_file
+import io
 import os
+import math
+import numpy as np
 from ..application import app, db
 from ..model import DataFile
+from ..previews import placeholder, tile_levels, THUMBNAIL_SIZES, TILE_SIZE, COLLAPSE_METHODS
+from ..render import (render_queue, render_preview, render_thumbnail, render_collapsed,
+                      render_channel_image, render_tile, preview_job)
+from ..transport import TransportError
+from ..spectra import spectrum_unit, spatial_shape
 from .base import ViewBase
 
 class DataFileViewBase(ViewBase):
@@ -27,18 +37,232 @@ class DataFileView(DataFileViewBase, MethodView):
         return render_template("data/item.html", datafile=self.get_one(identifier))
     
 
+def _submit(identifier, function, *args):
+    """Queue a render job for the render workers.
+    
+    If the last job with this identifier failed, the request is aborted instead: with 404 for a
+    channel or tile outside the cube, 502 if the file couldn't be fetched, and 500 otherwise.
+    """
+    error = render_queue.error(identifier)
+    if isinstance(error, (IndexError, ValueError)):
+        abort(404)
+    elif isinstance(error, TransportError):
+        app.logger.error("Render job {0!r} couldn't fetch its file: {1!s}".format(identifier, error))
+        abort(502)
+    elif error is not None:
+        app.logger.error("Render job {0!r} failed: {1!r}".format(identifier, error))
+        abort(500)
+    render_queue.submit(identifier, function, *args)
+
+def _accepted(response):
+    """Mark a response as a placeholder for a queued render job, with 202 Accepted."""
+    response.status_code = 202
+    response.headers['Retry-After'] = str(app.config.get('PREVIEW_RETRY_AFTER', 2))
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+def _queued(identifier, function, *args):
+    """Queue a render job for the render workers, and return a placeholder image with 202 Accepted."""
+    _submit(identifier, function, *args)
+    response = make_response(placeholder())
+    response.headers['Content-Type'] = 'image/png'
+    return _accepted(response)
+
 @app.route('/datafile/<int:identifier>/preview')
 def get_datafile_preview(identifier):
-    """Get a preview for a datafile."""
-    datafile = DataFile.query.get(identifier)
-    path = os.path.abspath(datafile.preview())
-    return send_file(path)
+    """Get a preview for a datafile.
+    
+    Previews which haven't been rendered yet are queued for the render workers,
+    and a placeholder is returned with 202 Accepted until they are ready.
+    """
+    datafile = DataFile.query.get_or_404(identifier)
+    path = datafile.cached_preview()
+    if path is not None:
+        return send_file(os.path.abspath(path))
+    return _queued(datafile.id, render_preview, preview_job(datafile))
+
+@app.route('/datafile/<int:identifier>/thumbnail/<int:size>')
+def get_datafile_thumbnail(identifier, size):
+    """Get a thumbnail for a datafile, rendered without matplotlib.
+    
+    Like previews, thumbnails which haven't been rendered yet are queued for the
+    render workers, as collapsing a cube is too slow for a web request.
+    """
+    if size not in THUMBNAIL_SIZES:
+        abort(404)
+    datafile = DataFile.query.get_or_404(identifier)
+    path = datafile.cached_thumbnail(size)
+    if path is not None:
+        return send_file(os.path.abspath(path))
+    return _queued((datafile.id, size), render_thumbnail, preview_job(datafile), size)
+
+def _collapse_args():
+    """Get the (start, stop) channel range and collapse method from the request arguments."""
+    method = request.args.get('method', None)
+    if method is not None and method not in COLLAPSE_METHODS:
+        abort(400)
+    start, stop = request.args.get('start', None, type=int), request.args.get('stop', None, type=int)
+    if start is None and stop is None:
+        return None, method
+    if start is None or stop is None:
+        abort(400)
+    return (start, stop), method
+
+@app.route('/datafile/<int:identifier>/slice/<int:start>')
+@app.route('/datafile/<int:identifier>/slice/<int:start>/<int:stop>')
+def get_datafile_slice(identifier, start, stop=None):
+    """Get an image of one wavelength channel of a cube, or of the channels from start to stop collapsed.
+    
+    Images which haven't been rendered yet are queued like previews.
+    """
+    size = request.args.get('size', max(THUMBNAIL_SIZES), type=int)
+    if size not in THUMBNAIL_SIZES:
+        abort(404)
+    method = _collapse_args()[1]
+    channels = (start, start + 1 if stop is None else stop)
+    datafile = DataFile.query.get_or_404(identifier)
+    path = datafile.cached_channel_image(channels, size, method)
+    if path is not None:
+        return send_file(os.path.abspath(path))
+    return _queued((datafile.id, 'slice', channels, size, method),
+                   render_channel_image, preview_job(datafile), channels, size, method)
+
+@app.route('/datafile/<int:identifier>/tiles/')
+def get_datafile_tiles(identifier):
+    """Describe the image pyramid of a cube, optionally for a range of channels given by ``start`` and ``stop``.
+    
+    Until the cube has been collapsed by the render workers, this returns ``{"pending": true}`` with 202 Accepted.
+    """
+    channels, method = _collapse_args()
+    datafile = DataFile.query.get_or_404(identifier)
+    collapsed = datafile.cached_collapsed(method, channels)
+    if collapsed is None:
+        _submit((datafile.id, 'collapsed', channels, method), render_collapsed, preview_job(datafile), method, channels)
+        return _accepted(jsonify(pending=True))
+    shape = collapsed.shape
+    return jsonify(shape=list(shape), levels=tile_levels(shape), tile_size=TILE_SIZE)
+
+@app.route('/datafile/<int:identifier>/tiles/<int:z>/<int:x>/<int:y>.png')
+def get_datafile_tile(identifier, z, x, y):
+    """Get a tile of the image pyramid of a cube, optionally for a range of channels given by ``start`` and ``stop``.
+    
+    Tiles which haven't been rendered yet are queued like previews.
+    """
+    channels, method = _collapse_args()
+    datafile = DataFile.query.get_or_404(identifier)
+    path = datafile.cached_tile(z, x, y, channels, method)
+    if path is not None:
+        return send_file(os.path.abspath(path))
+    return _queued((datafile.id, 'tile', z, x, y, channels, method),
+                   render_tile, preview_job(datafile), z, x, y, channels, method)
+
+@app.route('/datafile/<int:identifier>/spectrum')
+def get_datafile_spectrum(identifier):
+    """Get the spectrum summed in an aperture of radius ``r`` around spaxel (``x``, ``y``) of a cube.
+    
+    The spectrum is JSON, or a ``.npy`` record array of wavelength and flux with ``format=npy``.
+    """
+    x, y = request.args.get('x', None, type=int), request.args.get('y', None, type=int)
+    r = request.args.get('r', 0.0, type=float)
+    if x is None or y is None or not 0 <= r < math.inf:
+        abort(400)
+    datafile = DataFile.query.get_or_404(identifier)
+    try:
+        # A larger aperture than the cube's diagonal covers the same spaxels, and would share its cached spectrum.
+        r = min(r, math.hypot(*spatial_shape(datafile.local_path())))
+        spectrum = datafile.spectrum(x, y, r)
+    except (IndexError, ValueError):
+        abort(404)
+    except TransportError as e:
+        app.logger.error("Fetching {0!r} failed: {1!s}".format(datafile, e))
+        abort(502)
+    if request.args.get('format', 'json') == 'npy':
+        buffer = io.BytesIO()
+        np.save(buffer, spectrum)
+        response = make_response(buffer.getvalue())
+        response.headers['Content-Type'] = 'application/octet-stream'
+        return response
+    return jsonify(x=x, y=y, r=r, unit=spectrum_unit(spectrum),
+                   wavelength=spectrum['wavelength'].tolist(), flux=spectrum['flux'].tolist())
+
+def _accel_redirect(path):
+    """The internal URI for a file under a directory served by nginx, or None."""
+    for directory, location in app.config.get('DATAFILE_ACCEL_REDIRECT', {}).items():
+        directory = os.path.join(os.path.abspath(directory), "")
+        if path.startswith(directory):
+            return location.rstrip("/") + "/" + path[len(directory):]
+    return None
+
+class _FileRange(object):
+    """A file object which reads at most ``length`` bytes from the current position of a file."""
+    
+    def __init__(self, f, length):
+        self._file = f
+        self._remaining = length
+    
+    def read(self, size=-1):
+        if size < 0 or size > self._remaining:
+            size = self._remaining
+        data = self._file.read(size)
+        self._remaining -= len(data)
+        return data
+    
+    def close(self):
+        self._file.close()
+
+def send_datafile(datafile):
+    """Send a data file as an attachment, with a strong ETag, Last-Modified, and Range support.
+    
+    Where possible, the bytes are copied by the kernel: by the web server for files under
+    ``DATAFILE_ACCEL_REDIRECT`` directories or with ``USE_X_SENDFILE``, or otherwise by the
+    WSGI server's file wrapper. Ranges are read from their start offset, but only the web
+    server can send them with sendfile.
+    """
+    try:
+        path = os.path.abspath(datafile.local_path())
+        stat = os.stat(path)
+    except FileNotFoundError:
+        abort(404)
+    except TransportError as e:
+        app.logger.error("Fetching {0!r} failed: {1!s}".format(datafile, e))
+        abort(502)
+    
+    headers = Headers()
+    headers.add('Content-Disposition', 'attachment', filename=datafile.basename)
+    location = _accel_redirect(path)
+    if location is not None or app.use_x_sendfile:
+        # The front-end server sends the file, and handles ranges itself.
+        if location is not None:
+            headers['X-Accel-Redirect'] = location
+        else:
+            headers['X-Sendfile'] = path
+        response = app.response_class(None, mimetype='application/octet-stream', headers=headers)
+        response.set_etag(datafile.etag(stat))
+        response.last_modified = stat.st_mtime
+        return response.make_conditional(request)
+    
+    # The body is attached once the status is known, so that a range is read from its
+    # start, instead of werkzeug reading and discarding everything before it.
+    response = app.response_class(None, mimetype='application/octet-stream', headers=headers,
+                                  direct_passthrough=True)
+    response.headers['Accept-Ranges'] = 'bytes'
+    response.set_etag(datafile.etag(stat))
+    response.last_modified = stat.st_mtime
+    response = response.make_conditional(request, accept_ranges=True, complete_length=stat.st_size)
+    if response.status_code == 206:
+        start, stop = response.content_range.start, response.content_range.stop
+        f = open(path, 'rb')
+        f.seek(start)
+        response.response = wrap_file(request.environ, _FileRange(f, stop - start))
+    elif response.status_code == 200:
+        response.response = wrap_file(request.environ, open(path, 'rb'))
+        response.content_length = stat.st_size
+    return response
 
 @app.route('/datafile/<int:identifier>/download')
 def download_datafile(identifier):
     """Download a data file."""
-    datafile = DataFile.query.get(identifier)
-    path = os.path.abspath(datafile.filename)
-    return send_file(path, as_attachment=True)
+    datafile = DataFile.query.get_or_404(identifier)
+    return send_datafile(datafile)
 
 DataFileView.register_api(app, 'datafile', '/datafile/')
\ No newline at end of file
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Round trips of frame headers through a base header and a delta.
+"""
+
+from astropy.io import fits
+
+from osirisdb.model.fits import header_cards, header_delta, header_delta_keywords, apply_header_delta
+
+def make_header(longstr, comments=2, history=1, extra=False):
+    """A header with a long string value followed by COMMENT and HISTORY cards."""
+    header = fits.Header()
+    header['SIMPLE'] = True
+    header['OBJECT'] = 'M31'
+    header['LONGSTR'] = longstr
+    for i in range(comments):
+        header.add_comment("comment {0:d}".format(i))
+    if extra:
+        header['ADDED'] = (1, "A keyword which is not in the base header")
+    header['ITIME'] = 10.0
+    for i in range(history):
+        header.add_history("history {0:d}".format(i))
+    return header
+
+def assert_round_trip(base, header):
+    delta = header_delta(base, header)
+    result = apply_header_delta(base, delta)
+    assert header_cards(result) == header_cards(header)
+    assert list(result.keys()) == list(header.keys())
+    return result
+
+def test_longer_continue_value():
+    base = make_header("x" * 100)
+    header = make_header("y" * 200)
+    result = assert_round_trip(base, header)
+    assert result['LONGSTR'] == "y" * 200
+
+def test_shorter_continue_value():
+    base = make_header("x" * 200)
+    header = make_header("y" * 100, comments=3)
+    assert_round_trip(base, header)
+
+def test_added_and_removed_cards():
+    base = make_header("x" * 100, comments=3, history=2)
+    header = make_header("x" * 100, comments=1, history=3, extra=True)
+    assert_round_trip(base, header)
+    assert 'ADDED' in header_delta_keywords(base, header_delta(base, header))
+
+def test_identical_header():
+    base = make_header("x" * 200)
+    delta = header_delta(base, base)
+    assert all(op[0] == '=' for op in delta['script'])
+    assert header_delta_keywords(base, delta) == set()
+    assert_round_trip(base, base)
+
+def test_without_base():
+    assert_round_trip(None, make_header("y" * 200))